@@ -0,0 +1,444 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 CloudVPS
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks better_staticweb against an in-process stand-in for swift and
+memcache, serving synthetic containers of 10, 10k and 1M objects.
+
+Run it from a checkout, with swift, jinja2 and eventlet installed:
+
+    python benchmark.py
+    python benchmark.py -n 500 -o listing_page_size=1000 --json
+
+Each scenario reports requests per second, the median and 99th percentile
+latency, the number of subrequests per request and the peak memory use of
+the process so far.
+"""
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import gc
+import json
+import resource
+import time
+from StringIO import StringIO
+
+import better_staticweb
+
+
+ACCOUNT = 'AUTH_bench'
+
+#: The sizes of the synthetic containers.
+SIZES = [('10', 10), ('10k', 10000), ('1m', 1000000)]
+
+#: Objects are spread over pseudo-directories of this many objects.
+OBJECTS_PER_DIR = 1000
+
+CUSTOM_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><title>{{path|e}}</title></head>
+<body>
+<h1>{{path|e}}</h1>
+<ul>
+{% for subdir in subdirs %}
+<li class="dir"><a href="{{subdir.subdir|e}}">{{subdir.subdir|e}}</a></li>
+{% endfor %}
+{% for file in files %}
+<li class="{{file.type_classes}}"><a href="{{file.name|e}}">{{file.name|e}}</a>
+    {{file.size}} {{file.date}}</li>
+{% endfor %}
+</ul>
+{% if next_url %}<a href="{{next_url|e}}">next</a>{% endif %}
+</body>
+</html>
+"""
+
+ERROR_PAGE = """<!DOCTYPE html>
+<html><body><h1>Not found</h1><p>Nothing to see here.</p></body></html>
+"""
+
+
+class FakeMemcache(object):
+    """
+    Stands in for swift's MemcacheRing, serializing and expiring values the
+    same way.
+    """
+
+    def __init__(self):
+        self.data = {}
+        #: Returns the current time; replace it to let entries expire.
+        self.clock = time.time
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            return None
+
+        serialized, value, expires = value
+        if expires and expires <= self.clock():
+            del self.data[key]
+            return None
+        return json.loads(value) if serialized else value
+
+    def set(self, key, value, serialize=True, time=0, min_compress_len=0):
+        self.data[key] = (
+            serialize, json.dumps(value) if serialize else value,
+            self.clock() + time if time else 0)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key, delta=1, time=0):
+        value = int(self.get(key) or 0) + delta
+        self.set(key, value)
+        return value
+
+
+class SyntheticNames(object):
+    """
+    The sorted object names of a synthetic container, without holding them
+    in memory.
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return 'd%04d/o%07d.txt' % (index // OBJECTS_PER_DIR, index)
+
+
+class SyntheticDirs(object):
+    """
+    The sorted pseudo-directories holding a range of synthetic objects.
+    """
+
+    def __init__(self, start, stop):
+        self.first = start // OBJECTS_PER_DIR
+        self.count = (stop - 1) // OBJECTS_PER_DIR - self.first + 1 \
+            if stop > start else 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return 'd%04d/' % (self.first + index)
+
+
+class FakeSwift(object):
+    """
+    A WSGI app answering like swift's proxy, serving synthetic containers
+    named after their size. Containers starting with 'c' have a custom
+    listing template and error pages; those starting with 'p' use the
+    defaults. Both allow anonymous listings.
+
+    The template and error pages are objects, but aren't part of the
+    listings.
+    """
+
+    def __init__(self):
+        self.containers = {}
+        for label, count in SIZES:
+            self.containers['c' + label] = count
+            self.containers['p' + label] = count
+
+        self.extra_objects = {
+            'listing.html': CUSTOM_TEMPLATE,
+            '404error.html': ERROR_PAGE,
+        }
+        #: The number of requests made to the app.
+        self.calls = 0
+        self._listings = {}
+
+    def __call__(self, env, start_response):
+        self.calls += 1
+
+        parts = env['PATH_INFO'].split('/', 4)[2:]
+        if len(parts) == 1:
+            return self.account(env, start_response)
+
+        count = self.containers.get(parts[1])
+        if count is None:
+            return self.respond(start_response, '404 Not Found', 'Not Found')
+
+        if len(parts) == 3 and parts[2]:
+            return self.object(env, start_response, count, parts[2])
+
+        return self.container(env, start_response, parts[1], count)
+
+    def respond(self, start_response, status, body, headers=()):
+        headers = list(headers)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+    def account(self, env, start_response):
+        body = json.dumps([
+            {'name': name, 'count': count, 'bytes': count * 1000}
+            for name, count in sorted(self.containers.items())])
+        if env['REQUEST_METHOD'] == 'HEAD':
+            body = ''
+
+        return self.respond(start_response, '200 OK', body, [
+            ('Content-Type', 'application/json; charset=utf-8'),
+            ('X-Account-Container-Count', str(len(self.containers))),
+        ])
+
+    def object(self, env, start_response, count, name):
+        body = self.extra_objects.get(name)
+
+        if body is None:
+            names = SyntheticNames(count)
+            index = bisect.bisect_left(names, name)
+            if index == count or names[index] != name:
+                return self.respond(start_response, '404 Not Found',
+                                    'Not Found')
+            body = 'x' * (index % 4096)
+
+        if env['REQUEST_METHOD'] == 'HEAD':
+            body = ''
+
+        return self.respond(start_response, '200 OK', body, [
+            ('Content-Type', 'text/html'),
+            ('ETag', '"%032x"' % len(body)),
+        ])
+
+    def container(self, env, start_response, container, count):
+        headers = [
+            ('X-Container-Object-Count', str(count)),
+            ('X-Container-Bytes-Used', str(count * 2048)),
+            ('X-Container-Read', '.r:*,.rlistings'),
+            ('X-Container-Meta-Web-Listings', 'on'),
+            ('Content-Type', 'application/json; charset=utf-8'),
+        ]
+        if container.startswith('c'):
+            headers.extend([
+                ('X-Container-Meta-Web-Listings-Template', 'listing.html'),
+                ('X-Container-Meta-Web-Error', 'error.html'),
+            ])
+
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return self.respond(start_response, '204 No Content', '',
+                                headers)
+
+        # Listings are generated once, so mostly the middleware is measured.
+        key = (count, env.get('QUERY_STRING', ''))
+        body = self._listings.get(key)
+        if body is None:
+            body = self._listings[key] = self.listing(
+                count, better_staticweb.urlparse.parse_qs(key[1]))
+
+        return self.respond(start_response, '200 OK', body, headers)
+
+    def listing(self, count, params):
+        def param(name, default=''):
+            return params.get(name, [default])[0]
+
+        prefix = param('prefix')
+        marker = param('marker')
+        end_marker = param('end_marker')
+        limit = int(param('limit', 10000))
+        reverse = param('reverse') == 'true'
+
+        names = SyntheticNames(count)
+        start = bisect.bisect_left(names, prefix)
+        stop = bisect.bisect_left(names, prefix + '\xff')
+
+        if param('delimiter') and '/' not in prefix:
+            entries = SyntheticDirs(start, stop)
+            offset = 0
+        else:
+            entries = names
+            offset = start
+
+        def index_of(name):
+            # The position of name among the entries, counted from offset.
+            return bisect.bisect_left(entries, name) - offset
+
+        size = len(entries) if entries is not names else stop - start
+        first, last = 0, size
+        if reverse:
+            if marker:
+                last = min(last, index_of(marker))
+            if end_marker:
+                first = max(first, bisect.bisect_right(
+                    entries, end_marker) - offset)
+            indices = range(last - 1, max(first, last - limit) - 1, -1)
+        else:
+            if marker:
+                first = max(first, bisect.bisect_right(
+                    entries, marker) - offset)
+            if end_marker:
+                last = min(last, index_of(end_marker))
+            indices = range(first, min(last, first + limit))
+
+        listing = []
+        for index in indices:
+            name = entries[offset + index]
+            if entries is not names:
+                listing.append({'subdir': name})
+            else:
+                listing.append({
+                    'name': name,
+                    'hash': '%032x' % (offset + index),
+                    'bytes': (offset + index) % 4096,
+                    'content_type': 'text/plain',
+                    'last_modified': '2013-06-01T12:00:00.000000',
+                })
+
+        return json.dumps(listing)
+
+
+def make_request(app, path, cache, accept='text/html'):
+    env = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost',
+        'HTTP_ACCEPT': accept,
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(''),
+    }
+    if cache is not None:
+        env['swift.cache'] = cache
+
+    if '?' in path:
+        env['PATH_INFO'], env['QUERY_STRING'] = path.split('?', 1)
+
+    status = []
+
+    def start_response(response_status, headers, exc_info=None):
+        status.append(response_status)
+
+    body = app(env, start_response)
+    try:
+        size = sum(len(chunk) for chunk in body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+    return status[0], size
+
+
+def scenarios():
+    """
+    Yields the name, path and expected status of every scenario.
+    """
+    for label, count in SIZES:
+        last_dir = 'd%04d' % ((count - 1) // OBJECTS_PER_DIR)
+        base = '/v1/%s/' % ACCOUNT
+        yield ('listing-root-%s' % label,
+               base + 'c%s/' % label, '200')
+        yield ('listing-default-%s' % label,
+               base + 'p%s/%s/' % (label, last_dir), '200')
+        yield ('object-%s' % label,
+               base + 'c%s/%s/o%07d.txt' % (label, last_dir, count - 1), '200')
+        yield ('redirect-%s' % label,
+               base + 'c%s/%s' % (label, last_dir), '302')
+        yield ('error-page-%s' % label,
+               base + 'c%s/missing.html' % label, '404')
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run(requests, conf, use_memcache, only=None):
+    backend = FakeSwift()
+    app = better_staticweb.filter_factory({}, **conf)(backend)
+
+    results = []
+    for name, path, expected in scenarios():
+        if only and not any(part in name for part in only):
+            continue
+
+        # Every scenario starts with empty memcache, but a warmed up process.
+        cache = FakeMemcache() if use_memcache else None
+        gc.collect()
+
+        backend.calls = 0
+        latencies = []
+        started = time.time()
+        for i in range(requests):
+            request_started = time.time()
+            status, size = make_request(app, path, cache)
+            latencies.append(time.time() - request_started)
+
+            if not status.startswith(expected):
+                raise AssertionError('%s: expected %s, got %s' % (
+                    name, expected, status))
+        elapsed = time.time() - started
+
+        latencies.sort()
+        results.append({
+            'scenario': name,
+            'requests_per_second': requests / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'subrequests': float(backend.calls) / requests,
+            'response_bytes': size,
+            'peak_rss_mb':
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='requests per scenario (default: %(default)s)')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='a middleware setting, like in proxy-server.conf')
+    parser.add_argument('-s', '--scenario', action='append',
+                        help='only run scenarios whose name contains this')
+    parser.add_argument('--no-memcache', action='store_true',
+                        help='run without memcache')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    conf = {'template_path': '/nonexistent/'}
+    for option in args.option:
+        key, _, value = option.partition('=')
+        conf[key.strip()] = value.strip()
+
+    results = run(args.requests, conf, not args.no_memcache, args.scenario)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print('%-22s %10s %9s %9s %8s %9s %9s' % (
+        'scenario', 'req/s', 'p50 ms', 'p99 ms', 'subreqs', 'bytes',
+        'peak MB'))
+    for result in results:
+        print('%(scenario)-22s %(requests_per_second)10.1f %(p50_ms)9.2f '
+              '%(p99_ms)9.2f %(subrequests)8.2f %(response_bytes)9d '
+              '%(peak_rss_mb)9.1f' % result)
+
+
+if __name__ == '__main__':
+    main()
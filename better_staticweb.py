@@ -15,17 +15,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from urllib import quote as urllib_quote
+from urllib import quote as urllib_quote, unquote
 
 from swift.common.swob import Response
-from swift.common.utils import cache_from_env, split_path, json, human_readable
+from swift.common.utils import cache_from_env, split_path, json, \
+    config_true_value, get_logger, streq_const_time
 
 from StringIO import StringIO
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import md5
+from xml.sax.saxutils import escape
+
+from eventlet import GreenPile, Timeout
+from eventlet.event import Event
 
 import jinja2
+from jinja2.bccache import BytecodeCache, FileSystemBytecodeCache
+from jinja2.exceptions import SecurityError
+from jinja2.sandbox import SandboxedEnvironment
+import heapq
 import itertools
+import re
 import urlparse
 import os.path
+import time
+import types
+import uuid
+import zlib
 
 from swift.proxy.controllers.base import get_container_info
 
@@ -58,9 +75,9 @@ default_template = """
     <h1 id="title">Listing of {{path|e}}</h1>
     <table id="listing">
       <tr id="heading">
-        <th class="colname">Name</th>
-        <th class="colsize">Size</th>
-        <th class="coldate">Date</th>
+        <th class="colname"><a href="{{sort_urls.name|e}}">Name</a></th>
+        <th class="colsize"><a href="{{sort_urls.size|e}}">Size</a></th>
+        <th class="coldate"><a href="{{sort_urls.date|e}}">Date</a></th>
       </tr>
 
       {% if not at_root %}
@@ -87,6 +104,12 @@ default_template = """
       </tr>
       {% endfor %}
     </table>
+    {% if prev_url or next_url %}
+    <p id="pages">
+      {% if prev_url %}<a href="{{prev_url|e}}">&laquo; Previous</a>{% endif %}
+      {% if next_url %}<a href="{{next_url|e}}">Next &raquo;</a>{% endif %}
+    </p>
+    {% endif %}
   </body>
 </html>
 """
@@ -101,6 +124,415 @@ def quote(value, safe='/'):
     return urllib_quote(value, safe)
 
 
+#: Custom error pages larger than this aren't kept in memory.
+MAX_CACHED_ERROR_PAGE = 256 * 1024
+
+#: Listing templates of containers larger than this aren't read, but
+#: rejected like templates breaking the sandbox.
+MAX_TEMPLATE_SIZE = 256 * 1024
+
+#: The number of URLs a sitemap may hold; larger ones are split into parts.
+SITEMAP_MAX_URLS = 50000
+
+#: Object indexes larger than this aren't kept in memcache.
+MAX_CACHED_INDEX = 512 * 1024
+
+#: The content types of the object indexes (?format=...) we generate.
+INDEX_FORMATS = {
+    'sitemap': 'application/xml; charset=UTF-8',
+    'index': 'application/json; charset=UTF-8',
+}
+
+
+def close_iterable(iterable):
+    """
+    Closes a WSGI response iterable, if it can be closed. Responses we don't
+    pass on must be closed to release their backend connections.
+    """
+    close = getattr(iterable, 'close', None)
+    if close:
+        close()
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of a JSON array, like a listing, while its text is read
+    from an iterable of chunks, so the whole text is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    separators = ' \t\r\n,[]'
+    buf = ''
+    pos = 0
+
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+
+        while True:
+            while pos < len(buf) and buf[pos] in separators:
+                pos += 1
+            if pos == len(buf):
+                break
+
+            try:
+                item, pos_end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The item isn't complete yet; wait for the next chunk.
+                break
+
+            pos = pos_end
+            yield item
+
+    if buf[pos:].strip(separators):
+        raise ValueError("Truncated JSON array")
+
+
+def make_compressor(encoding, level):
+    """
+    Returns a zlib compressor for the gzip or deflate content-coding.
+    """
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return zlib.compressobj(level)
+
+
+def compress(data, encoding, level):
+    """
+    Compresses data with the gzip or deflate content-coding.
+    """
+    compressor = make_compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class PrefetchedIterable(object):
+    """
+    A WSGI response iterable whose first chunk was read already, to make the
+    application call start_response. close() is passed on to the original
+    iterable, unlike with itertools.chain.
+
+    :param iterable: The original response iterable.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        try:
+            self.first = [self.iterator.next()]
+        except StopIteration:
+            self.first = []
+
+    def __iter__(self):
+        return itertools.chain(self.first, self.iterator)
+
+    def close(self):
+        close_iterable(self.iterable)
+
+
+def fingerprint(value):
+    """
+    Returns an md5 hash of a structure of tuples, lists, dicts, strings and
+    numbers, which doesn't depend on whether its strings are str or unicode.
+    Values read back from memcache are unicode where they were str before.
+    """
+    def normalize(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, dict):
+            return sorted(normalize(item) for item in value.items())
+        elif isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        return value
+
+    return md5(repr(normalize(value))).hexdigest()
+
+
+class ClosingIterable(object):
+    """
+    A WSGI response iterable that calls a function once it's closed, after
+    closing the original iterable.
+
+    :param iterable: The original response iterable.
+    :param on_close: The function to call.
+    """
+
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            close_iterable(self.iterable)
+        finally:
+            self.on_close()
+
+
+class LRUCache(object):
+    """
+    A small least-recently-used cache, optionally expiring its entries.
+
+    :param size: The maximum number of entries to keep.
+    :param ttl: The number of seconds an entry stays valid; 0 keeps entries
+        until they're evicted.
+    :param name: The statsd metric hits and misses are counted under.
+    :param logger: The logger to send those metrics to.
+    :param max_bytes: The maximum total size of the entries, as given to
+        set(); 0 doesn't limit it.
+    """
+
+    def __init__(self, size, ttl=0, name=None, logger=None, max_bytes=0):
+        self.size = size
+        self.ttl = ttl
+        self.name = name
+        self.logger = logger if name else None
+        self.max_bytes = max_bytes
+        #: Number of lookups that were answered from the cache.
+        self.hits = 0
+        #: Number of lookups that weren't.
+        self.misses = 0
+        #: The total size of the entries kept.
+        self.bytes = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value, size = self._data.pop(key)
+        except KeyError:
+            self.count_miss()
+            return default
+
+        if expires and expires < time.time():
+            self.bytes -= size
+            self.count_miss()
+            return default
+
+        self._data[key] = (expires, value, size)
+        self.hits += 1
+        if self.logger:
+            self.logger.increment(self.name + '.hit')
+        return value
+
+    def count_miss(self):
+        self.misses += 1
+        if self.logger:
+            self.logger.increment(self.name + '.miss')
+
+    def set(self, key, value, size=0):
+        """
+        Keeps value under key, evicting the least recently used entries
+        beyond the cache's limits.
+
+        :param size: The size of value in bytes, counted against max_bytes.
+        """
+        if self.size <= 0 or (self.max_bytes and size > self.max_bytes):
+            self.delete(key)
+            return
+
+        self.delete(key)
+        self._data[key] = (
+            time.time() + self.ttl if self.ttl else 0, value, size)
+        self.bytes += size
+
+        while len(self._data) > self.size or (
+                self.max_bytes and self.bytes > self.max_bytes):
+            self.bytes -= self._data.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemcacheBytecodeCache(BytecodeCache):
+    """
+    Keeps compiled templates in memcache, so the proxy's worker processes
+    compile each version of a template once between them. Entries are keyed
+    by the template's origin; jinja2 recompiles a template whose source no
+    longer matches the entry's checksum.
+
+    :param timeout: The seconds compiled templates are kept.
+    """
+
+    def __init__(self, timeout=0):
+        self.timeout = timeout
+        #: The memcache client, set once the first request brings it along.
+        self.client = None
+
+    def load_bytecode(self, bucket):
+        if self.client is None:
+            return
+
+        code = self.client.get('better_static/bytecode/' + bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        if self.client is None:
+            return
+
+        self.client.set('better_static/bytecode/' + bucket.key,
+                        bucket.bytecode_to_string(), serialize=False,
+                        time=self.timeout)
+
+
+def compile_template(environment, name, source):
+    """
+    Compiles a template, loading it from the environment's bytecode cache
+    if that has it already. Environment.from_string() doesn't look there.
+
+    :param name: The name identifying the template in the bytecode cache.
+    """
+    bytecode_cache = environment.bytecode_cache
+    if bytecode_cache is None:
+        return environment.from_string(source)
+
+    bucket = bytecode_cache.get_bucket(environment, name, None, source)
+    if bucket.code is None:
+        bucket.code = environment.compile(source, name)
+        bytecode_cache.set_bucket(bucket)
+
+    return environment.template_class.from_code(
+        environment, bucket.code, environment.make_globals(None))
+
+
+class TemplateCache(LRUCache):
+    """
+    Keeps the compiled jinja2 template for each template origin (the default
+    template, a local file or a container object). Only the most recent
+    version of an origin is kept; a changed source replaces the stale one.
+    """
+
+    def get_template(self, origin, source, environment, version=None):
+        """
+        Returns the compiled template for source, compiling it only if this
+        version of the origin isn't cached yet.
+
+        :param origin: Where the template was loaded from.
+        :param source: The template source.
+        :param environment: The jinja2 environment to compile the template
+            in.
+        :param version: Something identifying the source, like an ETag.
+            Defaults to a hash of the source.
+        """
+        if version is None:
+            version = md5(source).hexdigest()
+
+        entry = self.get(origin)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        if entry is not None:
+            # get() counted this as a hit, but the cached version is stale.
+            self.hits -= 1
+            self.count_miss()
+
+        template = compile_template(environment, origin, source)
+        self.set(origin, (version, template))
+        return template
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent requests share a single call: the first request for a
+    key runs it, and others asking for the same key meanwhile wait for its
+    result instead of repeating it. Waiters run the call themselves if it
+    fails, returns None or takes longer than timeout seconds.
+
+    :param timeout: The seconds a waiter waits for the shared result.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        #: Number of calls whose result was shared with a waiting request.
+        self.shared = 0
+        #: Number of waiters that ended up running the call themselves.
+        self.fallbacks = 0
+        self._calls = {}
+
+    def run(self, key, call):
+        event = self._calls.get(key)
+        if event is not None:
+            result = None
+            with Timeout(self.timeout, False):
+                result = event.wait()
+
+            if result is not None:
+                self.shared += 1
+                return result
+
+            self.fallbacks += 1
+            return call()
+
+        event = self._calls[key] = Event()
+        result = None
+        try:
+            result = call()
+        finally:
+            del self._calls[key]
+            event.send(result)
+
+        return result
+
+
+#: The fields listings can be sorted on, along with their sort keys.
+SORT_KEYS = {
+    'name': lambda item: item.get('subdir') or item.get('name'),
+    'size': lambda item: item.get('bytes', 0),
+    'date': lambda item: item.get('last_modified', ''),
+}
+
+
+class LocalFileCache(object):
+    """
+    Keeps the contents of local files, like error pages and the listing
+    template, in memory. A file is checked again at most every
+    check_interval seconds, and only read again if its mtime changed.
+    Missing files are remembered as well.
+
+    :param check_interval: The seconds between checks of a file's mtime.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._files = {}
+
+    def get(self, path):
+        """
+        Returns the contents of a file and their md5 hash, or a tuple of Nones
+        if the file doesn't exist.
+        """
+        now = time.time()
+        checked, mtime, contents, digest = self._files.get(
+            path, (None, None, None, None))
+
+        if checked is not None and checked + self.check_interval > now:
+            return contents, digest
+
+        try:
+            new_mtime = os.stat(path).st_mtime
+        except OSError:
+            new_mtime = None
+
+        if checked is None or new_mtime != mtime:
+            contents = digest = None
+            if new_mtime is not None:
+                try:
+                    with open(path, 'r') as f:
+                        contents = f.read()
+                    digest = md5(contents).hexdigest()
+                except IOError:
+                    new_mtime = None
+
+        self._files[path] = (now, new_mtime, contents, digest)
+        return contents, digest
+
+
 class StaticWeb(object):
 
     """
@@ -119,11 +551,153 @@ class StaticWeb(object):
         self.app = app
         #: The filter configuration dict.
         self.conf = conf
+        #: The logger, which sends statsd metrics as well.
+        self.logger = get_logger(conf, log_route='better_staticweb')
+        #: Recently looked up container info, in front of memcache.
+        self.container_infos = LRUCache(
+            int(conf.get('container_info_cache_size', 1000)),
+            ttl=float(conf.get('container_info_ttl', 5)),
+            name='container_info_cache', logger=self.logger)
+        #: Whether recently requested pseudo-directories have an index object.
+        self.web_indexes = LRUCache(
+            10000, ttl=float(conf.get('web_index_ttl', 30)),
+            name='web_index_cache', logger=self.logger)
+        #: Where compiled templates are shared between worker processes.
+        self.bytecode_cache = self._bytecode_cache(
+            conf.get('template_bytecode_cache', ''))
+        #: The environment trusted (local and default) templates are
+        #: rendered in.
+        self.environment = jinja2.Environment(
+            bytecode_cache=self.bytecode_cache)
+        #: The sandbox listing templates from containers are rendered in.
+        self.sandbox = BudgetedEnvironment(
+            max_operations=int(conf.get('template_max_operations', 2000000)),
+            max_output=int(conf.get('template_max_output', 16777216)),
+            max_time=float(conf.get('template_max_time', 2)),
+            bytecode_cache=self.bytecode_cache)
+        #: The secret clients send in an X-Staticweb-Timing header to get one
+        #: back; timings show what's cached, so they're for operators only.
+        self.timing_header_key = conf.get('timing_header_key', '')
         #: The seconds to cache the x-container-meta-web-* headers.,
         self.cache_timeout = int(conf.get('cache_timeout', 300))
+        #: The seconds a container's generation lasts without writes through
+        #: this middleware; listing validators only change with it.
+        self.generation_timeout = int(conf.get('generation_timeout', 86400))
+        #: The compiled listing templates of this process.
+        self.template_cache = TemplateCache(
+            int(conf.get('template_cache_size', 100)),
+            name='template_cache', logger=self.logger)
+        #: The maximum number of entries shown on one listing page.
+        self.listing_page_size = int(conf.get('listing_page_size', 10000))
+        #: The custom error pages found (or not found) in containers.
+        self.error_pages = LRUCache(
+            int(conf.get('error_page_cache_size', 1000)),
+            ttl=self.cache_timeout, name='error_page_cache',
+            logger=self.logger,
+            max_bytes=int(conf.get('error_page_cache_bytes', 16777216)))
+        #: Whether recently requested missing objects were pseudo-directories.
+        self.directory_probes = LRUCache(
+            10000, ttl=float(conf.get('directory_probe_ttl', 30)),
+            name='directory_probe_cache', logger=self.logger)
+        #: Recently requested sorted or filtered views of public listings.
+        self.listing_views = LRUCache(
+            int(conf.get('listing_view_cache_size', 100)),
+            ttl=self.cache_timeout, name='listing_view_cache',
+            logger=self.logger)
+        #: Listing renders and template fetches in progress, which
+        #: concurrent requests for the same thing wait for.
+        self.flights = SingleFlight(float(conf.get('coalesce_timeout', 5)))
+        #: The zlib compression level of listings and error pages; 0 turns
+        #: compression off.
+        self.compress_level = int(conf.get('compress_level', 6))
+        #: The size, in bytes, below which responses aren't compressed.
+        self.compress_min_size = int(conf.get('compress_min_size', 1024))
+        #: The number of subrequests one request may run at the same time.
+        self.subrequest_concurrency = int(
+            conf.get('subrequest_concurrency', 2))
+        #: The error pages and listing template from template_path.
+        self.local_files = LocalFileCache(
+            float(conf.get('local_file_check_interval', 10)))
+        #: Whether containers can be mapped with ?format=sitemap and
+        #: ?format=index.
+        self.indexes = config_true_value(conf.get('indexes', 'false'))
+        #: Whether container listings are rendered while they're walked,
+        #: instead of one page at a time.
+        self.stream_listings = config_true_value(
+            conf.get('stream_listings', 'false'))
+        #: The listing templates fetched from containers, revalidated with
+        #: conditional requests once they're older than cache_timeout.
+        self.remote_templates = LRUCache(
+            int(conf.get('template_cache_size', 100)),
+            name='remote_template_cache', logger=self.logger)
 
         self._cache = None
 
+    def _bytecode_cache(self, setting):
+        """
+        Returns the jinja2 bytecode cache template_bytecode_cache asks for:
+        memcache, a directory (relative to template_path) or none at all.
+        """
+        if not setting:
+            return None
+
+        if setting == 'memcache':
+            return MemcacheBytecodeCache(
+                int(self.conf.get('template_bytecode_cache_time', 86400)))
+
+        directory = os.path.join(
+            self.conf.get('template_path', os.path.dirname(__file__)),
+            setting)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError, e:
+            self.logger.warning('Not caching template bytecode in %s: %s',
+                                directory, e)
+            return None
+
+        if not os.access(directory, os.W_OK):
+            self.logger.warning('Not caching template bytecode in %s: '
+                                'not writable', directory)
+            return None
+
+        return FileSystemBytecodeCache(directory)
+
+    def _written_containers(self, env, account, container, obj):
+        """
+        Returns the containers a write request changes, and whether it
+        changes their metadata: the container in the path, and the
+        destination of a COPY.
+        """
+        # Metadata only changes with writes to the container itself.
+        targets = [(account, container, not obj and
+                    env['REQUEST_METHOD'] in ('PUT', 'POST', 'DELETE'))]
+
+        destination = env.get('HTTP_DESTINATION')
+        if env['REQUEST_METHOD'] == 'COPY' and destination:
+            dest_account = unquote(
+                env.get('HTTP_DESTINATION_ACCOUNT') or account)
+            dest_container = unquote(destination).lstrip('/').split('/')[0]
+            if dest_container:
+                targets.append((dest_account, dest_container, False))
+
+        return targets
+
+    def invalidate(self, targets):
+        """
+        Drops the generation of changed containers, which invalidates all
+        listings rendered for them, and their metadata if that changed.
+
+        :param targets: The account, container and whether the metadata
+            changed, for each container.
+        """
+        for account, container, metadata in targets:
+            if self._cache:
+                self._cache.delete(
+                    'better_static/%s/%s' % (account, container))
+            if metadata:
+                self.container_infos.delete((account, container))
+
     def __call__(self, env, start_response):
         """
         Main hook into the WSGI paste.deploy filter/app pipeline.
@@ -139,14 +713,29 @@ class StaticWeb(object):
 
         if not self._cache:
             self._cache = cache_from_env(env)
+            if isinstance(self.bytecode_cache, MemcacheBytecodeCache):
+                self.bytecode_cache.client = self._cache
 
         # Don't handle non-GET requests or subrequests by other middleware.
         if env['REQUEST_METHOD'] not in ('HEAD', 'GET') or env.get('swift.source', None) != None:
 
-            # flush cache if we expect the container metadata being changed.
-            if container and not obj and self._cache:
-                memcache_key = 'better_static/%s/%s' % (account, container)
-                self._cache.delete(memcache_key)
+            # flush cache if we expect the container metadata or contents
+            # being changed, once they have been; a listing cached while the
+            # write was under way would outlive it otherwise.
+            if container and \
+                    env['REQUEST_METHOD'] in ('PUT', 'POST', 'DELETE', 'COPY'):
+                targets = self._written_containers(env, account, container,
+                                                   obj)
+
+                def invalidate():
+                    self.invalidate(targets)
+
+                try:
+                    answer = self.app(env, start_response)
+                except Exception:
+                    invalidate()
+                    raise
+                return ClosingIterable(answer, invalidate)
 
             return self.app(env, start_response)
 
@@ -154,27 +743,570 @@ class StaticWeb(object):
         # the html
         params = urlparse.parse_qs(env.get('QUERY_STRING', ''))
 
-        if 'format' in params and params['format'] != ['html']:
+        if 'format' in params and params['format'] != ['html'] and not (
+                self.indexes and container and
+                params['format'][0] in INDEX_FORMATS):
             return self.app(env, start_response)
 
         context = Context(self, env, account, container, obj)
         return context(env, start_response)
 
 
+#: The upper limit, divisor and suffix of each unit of human_readable_size.
+SIZE_UNITS = [
+    (1 << (10 * (index + 1)), float(1 << (10 * index)), suffix)
+    for index, suffix in enumerate(
+        ['byte', 'Kb', 'Mb', 'Gb', 'Tb', 'Pb', 'Eb', 'Zb', 'Yb'])
+]
+
+
 def human_readable_size(value):
     """
     Returns the byte size in a human readable format; for example 1048576 = "1Mb".
     """
-    value = float(value)
+    value = int(value)
+    if value < 1024:
+        return str(value), 'byte'
+
+    # Compare against integer limits and divide just once.
+    for limit, divisor, suffix in SIZE_UNITS:
+        if value < limit:
+            break
+
+    return ("%.0f" % (value / divisor)), suffix
+
+
+def human_readable(value):
+    """
+    Returns the byte size in a human readable format, like swift's
+    human_readable; for example 1048576 = "1Mi". Rounds with integer
+    arithmetic rather than floats.
+    """
+    value = int(value)
+    index = -1
+    while value >= 1024 and index < 7:
+        index += 1
+        value = (value + 512) >> 10
+
+    if index == -1:
+        return '%d' % value
+
+    return '%d%si' % (value, 'KMGTPEZY'[index])
+
+
+#: The type classes of recently seen content types and extensions.
+_type_classes_cache = {}
+
+
+def type_classes(content_type, name):
+    """
+    Returns the css classes of a file in listings, describing its content
+    type and extension; for example "type-text type-plain ext-txt".
+    """
+    extension = name.rsplit('.', 1)[-1] if '.' in name else None
+    key = (content_type, extension)
+
+    classes = _type_classes_cache.get(key)
+    if classes is None:
+        classes = " ".join(
+            ('type-%s' % t.replace(".", '-'))
+            for t in content_type.split('/'))
+        if extension is not None:
+            classes += " ext-" + extension
+
+        if len(_type_classes_cache) >= 4096:
+            _type_classes_cache.clear()
+        _type_classes_cache[key] = classes
+
+    return classes
+
+
+class ListingEntry(object):
+    """
+    A compact record of one entry of a listing, as passed to templates.
+    Templates may treat it like the dict it was made from; fields swift
+    adds that the record doesn't know about are kept in extra. Records are
+    decorated once, when they're made, and never changed afterwards, so
+    they may be shared between listings.
+    """
+
+    __slots__ = ('extra',)
+
+    def _set_extra(self, item):
+        extra = dict(
+            (k, v) for k, v in item.iteritems() if k not in self.__slots__)
+        self.extra = extra or None
+
+    def __getattr__(self, key):
+        # Only called for fields that weren't set.
+        if key != 'extra' and self.extra and key in self.extra:
+            return self.extra[key]
+        raise AttributeError(key)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class SubdirEntry(ListingEntry):
+    """
+    A subdir of a container listing, or a container of an account listing.
+
+    :param item: The entry, as parsed from the JSON listing.
+    :param prefix: The prefix to strip from the entry's name.
+    """
+
+    __slots__ = ('subdir', 'name', 'bytes', 'count', 'size', 'size_num',
+                 'size_unit')
+
+    def __init__(self, item, prefix=''):
+        self.name = item.get('name')
+        self.subdir = item.get('subdir', self.name)[len(prefix):]
+
+        if 'bytes' in item:
+            self.bytes = item['bytes']
+            self.count = item.get('count')
+            self.size = human_readable(self.bytes)
+            self.size_num, self.size_unit = human_readable_size(self.bytes)
+
+        self._set_extra(item)
+
+
+class FileEntry(ListingEntry):
+    """
+    An object of a container listing.
+
+    :param item: The entry, as parsed from the JSON listing.
+    :param prefix: The prefix to strip from the entry's name.
+    """
+
+    __slots__ = ('name', 'bytes', 'hash', 'content_type', 'last_modified',
+                 'size', 'size_num', 'size_unit', 'date', 'type_classes')
+
+    def __init__(self, item, prefix=''):
+        self.name = item['name'][len(prefix):]
+        self.bytes = item['bytes']
+        self.hash = item.get('hash')
+        self.content_type = item['content_type']
+        self.last_modified = self.date = item['last_modified']
+
+        self.size = human_readable(self.bytes)
+        self.size_num, self.size_unit = human_readable_size(self.bytes)
+        self.type_classes = type_classes(self.content_type, self.name)
+
+        self._set_extra(item)
+
+
+class ListingWalk(object):
+    """
+    The walk over a container listing that the subdirs and files of a
+    streamed listing share, so the listing is fetched once for both. While
+    the entries of one kind are looped over, those of the other are kept
+    for its first loop, up to limit of them; past that, the other kind
+    fetches the rest of the listing itself. Later loops over a kind walk the
+    listing again.
+
+    :param walk: A callable returning an iterator over the listing entries,
+        after the marker it's passed if any.
+    :param prefix: The prefix the entry names share, which markers leave
+        out.
+    :param limit: The number of entries kept for a kind at most.
+    """
+
+    def __init__(self, walk, prefix, limit):
+        self.walk = walk
+        self.prefix = prefix
+        self.limit = limit
+        #: The shared walk, once it has started.
+        self.entries = None
+        #: The entries passed over, by the kind that's still to loop.
+        self.kept = {'subdir': deque(), 'name': deque()}
+        #: The name of the last entry kept for each kind.
+        self.last_kept = {}
+        #: The marker to continue at, for kinds whose kept entries
+        #: overflowed.
+        self.resume = {}
+        #: The kinds whose first loop started.
+        self.started = set()
+        #: The kinds whose first loop ended.
+        self.done = set()
+
+    def iter_kind(self, kind):
+        """
+        Returns an iterator over the listing entries of a kind.
+
+        :param kind: 'subdir' or 'name', the key identifying the entries.
+        """
+        if kind in self.started:
+            return (item for item in self.walk() if kind in item)
+        self.started.add(kind)
+        return self._first_loop(kind)
+
+    def _first_loop(self, kind):
+        other = 'name' if kind == 'subdir' else 'subdir'
+        kept = self.kept[kind]
+
+        try:
+            while True:
+                if kept:
+                    yield kept.popleft()
+                    continue
+
+                if kind in self.resume:
+                    for item in self.walk(self.resume[kind]):
+                        if kind in item:
+                            yield item
+                    return
+
+                if self.entries is None:
+                    self.entries = self.walk()
+                item = next(self.entries, None)
+                if item is None:
+                    return
+
+                if kind in item:
+                    yield item
+                elif other not in self.done and other not in self.resume:
+                    if len(self.kept[other]) < self.limit:
+                        self.kept[other].append(item)
+                        self.last_kept[other] = item[other]
+                    else:
+                        self.resume[other] = \
+                            self.last_kept[other][len(self.prefix):]
+        finally:
+            self.done.add(kind)
+            kept.clear()
+
+
+class ListingStream(object):
+    """
+    The subdirs or files of a container listing, fetched while they're being
+    iterated. Templates can loop over it more than once, but can't take its
+    length.
+
+    :param listing: The ListingWalk over the listing.
+    :param kind: 'subdir' or 'name', the key identifying the wanted entries.
+    :param entry_class: The record class for the wanted entries.
+    :param prefix: The prefix to strip from entry names.
+    """
+
+    def __init__(self, listing, kind, entry_class, prefix):
+        self.listing = listing
+        self.kind = kind
+        self.entry_class = entry_class
+        self.prefix = prefix
+
+    def __iter__(self):
+        for item in self.listing.iter_kind(self.kind):
+            yield self.entry_class(item, self.prefix)
+
+
+#: The conversion specifiers of printf-style format strings, and the format
+#: specs of str.format() replacement fields.
+FORMAT_SPECS = re.compile(
+    r'%(?:\([^)]*\))?([-#0 +.*\d]*)[a-zA-Z%]|\{[^{}:]*:([^{}]*)\}')
+
+
+def format_widths(text):
+    """
+    Returns the sum of the widths and precisions in a format string, which
+    the formatted string may take on top of the format string itself.
+    """
+    return sum(int(number)
+               for specs in FORMAT_SPECS.findall(text)
+               for number in re.findall(r'\d+', ''.join(specs)))
+
 
-    suffixes = ['byte', 'Kb', 'Mb', 'Gb', 'Tb', 'Pb', 'Eb', 'Zb', 'Yb']
-    for suffix in suffixes:
-        if value < 1024:
-            return ("%.0f" % value), suffix
+class RenderBudgetExceeded(SecurityError):
+    """
+    Raised when rendering a user-supplied template takes too much work.
+    """
 
-        value /= 1024.0
 
-    return ("%.0f" % (value * 1024.0)), suffixes[-1]
+class RenderBudget(object):
+    """
+    What's left of the budget of one render of a sandboxed template.
+    """
+    __slots__ = ('operations', 'deadline')
+
+    def __init__(self, deadline):
+        self.operations = 0
+        self.deadline = deadline
+
+
+class BudgetedIterable(object):
+    """
+    Wraps a sequence or iterable a sandboxed template may loop over, so
+    every item taken from it counts against the render budget.
+    """
+
+    def __init__(self, environment, iterable):
+        self.environment = environment
+        self.iterable = iterable
+        self.budget = environment.budget
+
+    def __iter__(self):
+        environment = self.environment
+        for item in self.iterable:
+            # Taking an item from a listing walk may have let another
+            # render run, so make sure this one's budget is current.
+            environment.budget = self.budget
+            environment.spend()
+            yield item
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __nonzero__(self):
+        return bool(self.iterable)
+
+    def __getitem__(self, index):
+        self.environment.spend()
+        return self.iterable[index]
+
+    def __getattr__(self, name):
+        return getattr(self.iterable, name)
+
+
+def copy_filter_flags(function, wrapper):
+    """
+    Marks a wrapper of a jinja2 filter the way the filter is marked, so it
+    gets the same context or environment arguments.
+    """
+    for flag in ('contextfilter', 'evalcontextfilter', 'environmentfilter'):
+        if getattr(function, flag, False):
+            setattr(wrapper, flag, True)
+    return wrapper
+
+
+class BudgetedEnvironment(SandboxedEnvironment):
+    """
+    A sandboxed jinja2 environment for the listing templates containers
+    supply, which limits the work rendering one may take. Attribute and
+    item lookups, calls, loop iterations and multiplications count as
+    operations; output size and time spent are limited as well, and so is
+    the size of the values multiplication and powers build. A limit of 0
+    is no limit.
+
+    Templates of this environment are rendered through generate(), which
+    raises RenderBudgetExceeded once the budget is spent.
+
+    :param max_operations: The operations one render may perform.
+    :param max_output: The characters one render may output.
+    :param max_time: The seconds one render may take.
+    """
+
+    #: Loops over results of these types are counted.
+    iterable_types = (list, tuple, xrange, types.GeneratorType, ListingStream)
+
+    #: The operators that can build values far larger than their operands.
+    intercepted_binops = frozenset(['*', '**', '%'])
+
+    #: The string filters and methods that can, likewise.
+    sized_functions = frozenset(['center', 'expandtabs', 'format', 'indent',
+                                 'ljust', 'replace', 'rjust', 'truncate',
+                                 'wordwrap', 'zfill'])
+
+    #: The filters whose results may be looped over.
+    iterable_filters = ['batch', 'dictsort', 'groupby', 'list', 'map',
+                        'reject', 'rejectattr', 'reverse', 'select',
+                        'selectattr', 'slice', 'sort', 'unique']
+
+    def __init__(self, max_operations=0, max_output=0, max_time=0, **kwargs):
+        SandboxedEnvironment.__init__(self, **kwargs)
+        self.max_operations = max_operations
+        self.max_output = max_output
+        self.max_time = max_time
+        #: The budget of the render in progress.
+        self.budget = RenderBudget(0)
+
+        for name in self.iterable_filters:
+            if name in self.filters:
+                self.filters[name] = self._budgeted(self.filters[name])
+        for name in self.sized_functions:
+            if name in self.filters:
+                self.filters[name] = self._sized(name, self.filters[name])
+        self.globals['range'] = self._budgeted(self.globals['range'])
+
+    def _budgeted(self, function):
+        """
+        Wraps a filter or global function so loops over its result count.
+        """
+        def wrapper(*args, **kwargs):
+            return self.wrap(function(*args, **kwargs))
+
+        return copy_filter_flags(function, wrapper)
+
+    def _sized(self, name, function):
+        """
+        Wraps a string filter so it's refused if its result would be too
+        large.
+        """
+        def wrapper(*args, **kwargs):
+            # Context filters get the context or environment first.
+            strings = [arg for arg in args if isinstance(arg, basestring)]
+            text = strings[0] if strings else u''
+            self._check_string_call(
+                name, text, [arg for arg in args if arg is not text], kwargs)
+            return function(*args, **kwargs)
+
+        return copy_filter_flags(function, wrapper)
+
+    def _check_string_call(self, name, text, args, kwargs):
+        """
+        Refuses a call of a string filter or method (or %) whose result
+        would take more than the output limit, before making it.
+
+        :param text: The string the filter or method applies to.
+        """
+        if not self.max_output:
+            return
+
+        values = list(args) + list(kwargs.values())
+        numbers = sum(abs(value) for value in values
+                      if isinstance(value, (int, long)) and
+                      not isinstance(value, bool))
+        strings = [value for value in values
+                   if isinstance(value, basestring)]
+
+        if name == 'indent':
+            size = len(text) + (text.count('\n') + 1) * (numbers or 4)
+        elif name == 'expandtabs':
+            size = len(text) + text.count('\t') * (numbers or 8)
+        elif name == 'replace':
+            old, new = (strings + [u'', u''])[:2]
+            size = len(text) + len(new) * (
+                text.count(old) if old else len(text) + 1)
+        elif name in ('format', '%'):
+            size = len(text) + format_widths(text) + numbers + \
+                sum(len(value) for value in strings)
+        else:
+            size = len(text) + numbers
+
+        self._check_size(size, 'a string')
+
+    def wrap(self, value):
+        if isinstance(value, self.iterable_types):
+            return BudgetedIterable(self, value)
+        return value
+
+    def spend(self):
+        """
+        Counts an operation against the budget of the current render.
+        """
+        budget = self.budget
+        budget.operations += 1
+
+        if self.max_operations and budget.operations > self.max_operations:
+            raise RenderBudgetExceeded(
+                'template took more than %d operations' %
+                self.max_operations)
+
+        # Checking the time is slower than counting, so only do it now and
+        # then.
+        if budget.deadline and not budget.operations % 1024 and \
+                time.time() > budget.deadline:
+            raise RenderBudgetExceeded(
+                'template took more than %g seconds' % self.max_time)
+
+    def generate(self, template, context):
+        """
+        Yields the output of a template of this environment, within the
+        render budget.
+        """
+        budget = self.budget = RenderBudget(
+            time.time() + self.max_time if self.max_time else 0)
+
+        context = dict((key, self.wrap(value))
+                       for key, value in context.items())
+
+        size = 0
+        output = template.generate(context)
+        while True:
+            # Other renders may have run since this one last did.
+            self.budget = budget
+            try:
+                chunk = next(output)
+            except StopIteration:
+                return
+
+            size += len(chunk)
+            if self.max_output and size > self.max_output:
+                raise RenderBudgetExceeded(
+                    'template output more than %d characters' %
+                    self.max_output)
+            yield chunk
+
+    def _check_size(self, size, what):
+        """
+        Refuses to build a value that would take more than the output
+        limit, before building it.
+
+        :param size: The characters (or, for numbers, decimal digits) the
+            value would take.
+        """
+        if self.max_output and size > self.max_output:
+            raise RenderBudgetExceeded(
+                'template built %s of more than %d characters' %
+                (what, self.max_output))
+
+    def call_binop(self, context, operator, left, right):
+        self.spend()
+
+        numbers = (int, long)
+        if operator == '*':
+            for sequence, count in ((left, right), (right, left)):
+                if isinstance(sequence, (basestring, list, tuple)) and \
+                        isinstance(count, numbers):
+                    self._check_size(len(sequence) * count, 'a sequence')
+            if isinstance(left, numbers) and isinstance(right, numbers):
+                self._check_size(
+                    (left.bit_length() + right.bit_length()) * 0.302,
+                    'a number')
+        elif operator == '%' and isinstance(left, basestring):
+            args = right if isinstance(right, tuple) else (right,)
+            self._check_string_call('%', left, args, {})
+        elif operator == '**' and isinstance(left, numbers) and \
+                isinstance(right, numbers) and right > 0 and abs(left) > 1:
+            self._check_size(right * abs(left).bit_length() * 0.302,
+                             'a number')
+
+        return SandboxedEnvironment.call_binop(self, context, operator,
+                                               left, right)
+
+    def getattr(self, obj, attribute):
+        self.spend()
+
+        # Listing entries only hold data, so skip the sandbox's checks.
+        if isinstance(obj, ListingEntry) and attribute[:1] != '_':
+            try:
+                return getattr(obj, attribute)
+            except AttributeError:
+                return self.undefined(obj=obj, name=attribute)
+
+        return SandboxedEnvironment.getattr(self, obj, attribute)
+
+    def getitem(self, obj, argument):
+        self.spend()
+        return SandboxedEnvironment.getitem(self, obj, argument)
+
+    def call(__self, __context, __obj, *args, **kwargs):
+        __self.spend()
+
+        text = getattr(__obj, '__self__', None)
+        if isinstance(text, basestring) and \
+                getattr(__obj, '__name__', None) in __self.sized_functions:
+            __self._check_string_call(__obj.__name__, text, args, kwargs)
+        return __self.wrap(SandboxedEnvironment.call(
+            __self, __context, __obj, *args, **kwargs))
 
 
 class Context(object):
@@ -183,17 +1315,181 @@ class Context(object):
         self.app = outer.app
         self.conf = outer.conf
         self.cache_timeout = outer.cache_timeout
+        self.generation_timeout = outer.generation_timeout
+        self.template_cache = outer.template_cache
+        self.remote_templates = outer.remote_templates
+        self.listing_page_size = outer.listing_page_size
+        self.local_files = outer.local_files
+        self.error_pages = outer.error_pages
+        self.directory_probes = outer.directory_probes
+        self.subrequest_concurrency = outer.subrequest_concurrency
+        self.listing_views = outer.listing_views
+        self.flights = outer.flights
+        self.compress_level = outer.compress_level
+        self.compress_min_size = outer.compress_min_size
+        self.logger = outer.logger
+        self.environment = outer.environment
+        self.sandbox = outer.sandbox
+        self.container_infos = outer.container_infos
+        self.web_indexes = outer.web_indexes
+        self.timing_header_key = outer.timing_header_key
+        self.indexes = outer.indexes
+        self.stream_listings = outer.stream_listings
         self._cache = outer._cache
         self.account = account
         self.container = container
         self.obj = obj
         self.env = env
         self._container_info = None
+        self._generation = None
+        #: Validators (ETag, Last-Modified) to send along with a listing.
+        self.listing_headers = {}
+        #: The content-coding generated responses are compressed with.
+        self.encoding = self._response_encoding()
+        #: When handling the request started.
+        self.started = time.time()
+        #: The number of times and seconds spent per timed metric.
+        self.timings = {}
+        #: Whether a page of a listing walk failed, cutting the walk short.
+        self.walk_failed = False
+
+    def _response_encoding(self):
+        """
+        Returns the content-coding (gzip or deflate) the client accepts for
+        the pages we generate, or None.
+        """
+        if self.compress_level <= 0:
+            return None
+
+        accepted = {}
+        for item in self.env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            params = item.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[params[0].strip().lower()] = quality
+
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+                return encoding
+
+        return None
+
+    def encoded_etag(self, etag):
+        """
+        Returns the ETag of the compressed variant of a response, so it
+        doesn't match the uncompressed one.
+        """
+        if not self.encoding or not etag:
+            return etag
 
-    def do_internal_get(self, path, method="GET", preauthenticate=False):
+        if etag.endswith('"'):
+            return '%s-%s"' % (etag[:-1], self.encoding)
 
+        return '%s-%s' % (etag, self.encoding)
+
+    def compress_response(self, headers, body):
+        """
+        Compresses a generated response body held in memory, if the client
+        accepts it and the body is large enough.
+
+        :param headers: The list of response headers, updated in place.
+        :param body: The response body, as a string.
+        :returns: the body to send.
+        """
+        headers.append(('Vary', 'Accept-Encoding'))
+        if not self.encoding or len(body) < self.compress_min_size:
+            return body
+
+        body = compress(body, self.encoding, self.compress_level)
+        headers[:] = [
+            (k, self.encoded_etag(v) if k.lower() == 'etag' else v)
+            for k, v in headers if k.lower() != 'content-length']
+        headers.extend([
+            ('Content-Encoding', self.encoding),
+            ('Content-Length', str(len(body))),
+        ])
+        return body
+
+    def record_timing(self, metric, started):
+        """
+        Sends the time passed since started to statsd, and adds it to the
+        timings of this request.
+
+        :param metric: The statsd metric, like 'subrequest.listing'.
+        :param started: When the timed operation started.
+        """
+        elapsed = time.time() - started
+        self.logger.timing(metric, elapsed * 1000)
+
+        count, total = self.timings.get(metric, (0, 0.0))
+        self.timings[metric] = (count + 1, total + elapsed)
+
+    def timing_header_value(self):
+        """
+        Returns the X-Staticweb-Timing header, in the style of Server-Timing,
+        listing the time spent on each metric so far.
+        """
+        timings = ['total;dur=%.2f' % ((time.time() - self.started) * 1000)]
+        timings.extend(
+            '%s;dur=%.2f;count=%d' % (metric, total * 1000, count)
+            for metric, (count, total) in sorted(self.timings.items()))
+        return ', '.join(timings)
+
+    def capture_response(self, call):
+        """
+        Calls a WSGI application, catching its start_response parameters.
+        The body isn't read, except for the first chunk if the application
+        only calls start_response once it's being iterated.
+
+        :param call: A callable taking a start_response hook, that calls the
+            application.
+        :returns: the list of start_response parameters, along with the
+            iterable response.
+        """
+        found_status = []
+
+        def catch_status(status, headers, exc_info=None):
+            found_status.extend((status, headers))
+            if exc_info:
+                found_status.append(exc_info)
+
+        answer = call(catch_status)
+
+        if not found_status:
+            answer = PrefetchedIterable(answer)
+
+        assert found_status
+
+        return found_status, answer
+
+    def make_subrequest(self, path, method="GET", preauthenticate=False,
+                        headers=None, kind='other'):
+        """
+        Makes a subrequest, returning its status, headers and the response
+        iterable, without reading the response body.
+
+        :param kind: What the subrequest is for, like 'listing'; its timing
+            is reported under this name.
+        """
+        started = time.time()
         tmp_env = dict(self.env)
-        tmp_env['REQUEST_METHOD'] = "GET"
+        tmp_env['REQUEST_METHOD'] = method
+
+        # The client's conditional and range headers apply to the original
+        # request, not to whatever we need to fetch to answer it.
+        for key in tmp_env.keys():
+            if key.startswith('HTTP_IF_') or key == 'HTTP_RANGE':
+                del tmp_env[key]
+
+        for key, value in (headers or {}).items():
+            tmp_env['HTTP_' + key.upper().replace('-', '_')] = value
+
         if '?' in path:
             tmp_env['PATH_INFO'], tmp_env['QUERY_STRING'] = path.split('?', 1)
         else:
@@ -208,58 +1504,246 @@ class Context(object):
             tmp_env['swift.authorize_override'] = True
             tmp_env['REMOTE_USER'] = '.wsgi.pre_authed'
 
-        answer = [None, None, None]
+        found_status, body = self.capture_response(
+            lambda catch_status: self.app(tmp_env, catch_status))
+        self.record_timing('subrequest.' + kind, started)
 
-        def catch_result(status, headers, exc_info=None):
-            answer[0] = status
-            answer[1] = headers
+        status, headers = found_status[:2]
+        if isinstance(headers, dict):
+            headers = headers.items()
 
-        answer[2] = self.app(tmp_env, catch_result)
+        return status, headers, body
 
-        if not isinstance(answer[2], basestring):
-            answer[2] = "".join(answer[2])
+    def do_internal_get(self, path, method="GET", preauthenticate=False,
+                        headers=None, kind='other'):
+        """
+        Makes a subrequest, returning its status, headers and the whole
+        response body.
+        """
+        status, headers, chunks = self.make_subrequest(
+            path, method, preauthenticate, headers, kind)
 
-        if isinstance(answer[1], dict):
-            answer[1] = answer[1].items()
+        body = chunks
+        if not isinstance(body, basestring):
+            try:
+                body = "".join(chunks)
+            finally:
+                close_iterable(chunks)
 
-        return answer
+        self.logger.update_stats('buffered_bytes', len(body))
+        return [status, headers, body]
 
     def forward_request(self, env=None):
         """ Forwards the request to the backend, and returns the start_response
         parameters, along with the iterable response """
 
-        found_status = []
+        return self.capture_response(
+            lambda catch_status: self.app(env or self.env, catch_status))
+
+    def _get_container_info(self):
+        """
+        Retrieves all x-container-meta-web-* headers, and return them as a dict.
+        """
+
+        if not self.container:  # No configurable items in account
+            return {}
+
+        if self._container_info:
+            return self._container_info
+
+        cache_key = (self.account, self.container)
+        container_info = self.container_infos.get(cache_key)
+        if container_info is None:
+            started = time.time()
+            container_info = get_container_info(self.env, self.app,
+                                                swift_source='BSW') or {}
+            self.record_timing('subrequest.container_info', started)
+
+            # Don't remember failures other than a missing container; they're
+            # likely temporary.
+            status = container_info.get('status') or 0
+            if 200 <= status < 300 or status == 404:
+                self.container_infos.set(cache_key, container_info)
+
+        self._container_info = container_info
+        return container_info
+
+    def _get_generation(self):
+        """
+        Returns a token identifying the current contents of the container.
+        Every write to the container through this middleware drops the
+        token, so anything cached under it is invalidated; otherwise it
+        lasts generation_timeout seconds, so ETags stay the same between
+        renders of an unchanged listing.
+        """
+        if not self._cache or not self.container:
+            return None
+
+        if self._generation:
+            return self._generation
+
+        memcache_key = 'better_static/%s/%s' % (self.account, self.container)
+        generation = self._cache.get(memcache_key)
+        if generation:
+            # Memcache hands back unicode.
+            generation = str(generation)
+        else:
+            # The time the generation started doubles as the last
+            # modification time of the listings rendered for it.
+            generation = '%d-%s' % (time.time(), uuid.uuid4().hex)
+            self._cache.set(memcache_key, generation,
+                            time=self.generation_timeout)
+
+        self._generation = generation
+        return generation
 
-        def catch_status(status, headers, exc_info=None):
-            found_status.extend((status, headers))
-            if exc_info:
-                found_status.append(exc_info)
+    def _listing_is_public(self, use_preauth):
+        """
+        Returns whether anyone may see the listing of this container, so a
+        listing rendered for one client may be served to another.
+        """
+        if use_preauth:
+            return True
 
-        answer = self.app(env or self.env, catch_status)
+        read_acl = self._get_container_info().get('read_acl') or ''
+        referrers = [item.strip() for item in read_acl.split(',')]
+        return '.r:*' in referrers and '.rlistings' in referrers
 
-        if not found_status:
-            it = iter(answer)
-            first = it.next()
-            answer = itertools.chain([first], it)
+    def _listing_variant(self, template_version):
+        """
+        Returns a hash of everything besides the container contents that
+        affects the rendered listing of the current request.
+        """
+        return fingerprint((
+            self.obj,
+            template_version,
+            self.env.get('HTTP_ORIGINAL_PATH') or self.env['PATH_INFO'],
+            self.env.get('QUERY_STRING', ''),
+            any((header in self.env) for header in
+                ['HTTP_AUTHORIZATION', 'HTTP_X_AUTH_TOKEN']),
+            self._get_container_info().get('meta', {}),
+        ))
+
+    def _listing_cache_key(self, template_version):
+        """
+        Returns the memcache key for the listing of the current request.
+        """
+        generation = self._get_generation()
+        if not generation:
+            return None
 
-        assert found_status
+        return 'better_static/%s/%s/%s/%s' % (
+            self.account, self.container, generation,
+            self._listing_variant(template_version))
 
-        return found_status, answer
+    def _listing_validators(self, template_version):
+        """
+        Returns the ETag and Last-Modified headers for the listing of the
+        current request, derived from the container's state and the
+        template, without fetching the listing itself.
+        """
+        container_info = self._get_container_info()
+        generation = self._get_generation()
+
+        etag = fingerprint((
+            generation,
+            container_info.get('object_count'),
+            container_info.get('bytes'),
+            container_info.get('last_modified'),
+            self._listing_variant(template_version),
+        ))
+
+        headers = {
+            'ETag': self.encoded_etag('"%s"' % etag),
+            'Vary': 'Accept-Encoding',
+        }
+
+        last_modified = container_info.get('last_modified')
+        if not last_modified and generation:
+            last_modified = formatdate(
+                int(generation.split('-', 1)[0]), usegmt=True)
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+
+        return headers
+
+    def _is_not_modified(self, headers):
+        """
+        Returns whether the client's conditional headers show it already has
+        the response with the given validators.
+        """
+        etag = headers.get('ETag')
+        if_none_match = self.env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag is not None and (
+                '*' in tags or etag in tags or 'W/' + etag in tags)
+
+        last_modified = headers.get('Last-Modified')
+        if_modified_since = self.env.get('HTTP_IF_MODIFIED_SINCE')
+        if last_modified and if_modified_since:
+            last_modified = parsedate_tz(last_modified)
+            if_modified_since = parsedate_tz(if_modified_since)
+            if last_modified and if_modified_since:
+                return mktime_tz(last_modified) <= \
+                    mktime_tz(if_modified_since)
+
+        return False
+
+    def not_modified_response(self, headers, start_response):
+        """
+        Tells the remote client its copy of the response is still valid.
+        """
+        start_response('304 Not Modified', headers.items())
+        return [""]
 
-    def _get_container_info(self):
+    def get_error_page(self, code, web_error):
         """
-        Retrieves all x-container-meta-web-* headers, and return them as a dict.
+        Returns the headers and body iterable of the container's custom error
+        page for a status code, or False if the container doesn't have one.
+        Both are remembered for cache_timeout seconds, or until the container
+        changes; large pages are streamed instead.
+
+        :param code: The status code, as a string.
+        :param web_error: The value of x-container-meta-web-error.
         """
+        cache_key = (self.account, self.container, self._get_generation(),
+                     code, web_error)
+        error_page = self.error_pages.get(cache_key)
+        if error_page is not None:
+            return error_page
+
+        err_status, err_headers, err_body = self.make_subrequest(
+            "/v1/%s/%s/%s%s" % (self.account, self.container,
+                                code, web_error),
+            preauthenticate=True,
+            kind='error_page'
+        )
 
-        if not self.container:  # No configurable items in account
-            return {}
+        if err_status[:3] != '200':
+            close_iterable(err_body)
+            if err_status[:3] == '404':
+                self.error_pages.set(cache_key, False)
+                return False
 
-        if self._container_info:
-            return self._container_info
+            # Don't remember other failures; they're likely temporary.
+            return None
 
-        self._container_info = get_container_info(self.env, self.app,
-                                                  swift_source='BSW') or {}
-        return self._container_info
+        length = dict((k.lower(), v) for k, v in err_headers).get(
+            'content-length')
+        if length is None or int(length) > MAX_CACHED_ERROR_PAGE:
+            # Pass large pages on without reading them into memory.
+            return err_headers, err_body
+
+        try:
+            err_content = "".join(err_body)
+        finally:
+            close_iterable(err_body)
+        self.logger.update_stats('buffered_bytes', len(err_content))
+
+        error_page = (err_headers, [err_content])
+        self.error_pages.set(cache_key, error_page, len(err_content))
+        return error_page
 
     def error_response(self, status, headers, start_response):
         """
@@ -283,16 +1767,20 @@ class Context(object):
         container_info = self._get_container_info()
         web_error = container_info.get('meta', {}).get('web-error')
         if web_error:
-            err_status, err_headers, err_content = self.do_internal_get(
-                "/v1/%s/%s/%s%s" % (self.account, self.container,
-                                    status[:3], web_error),
-                preauthenticate=True
-            )
+            error_page = self.get_error_page(status[:3], web_error)
 
             # If the error page handler is found, use it.
-            if err_status[:3] == '200':
+            if error_page:
+                err_headers, err_content = error_page
                 # Merge the headers.
                 headers.extend(err_headers)
+                if isinstance(err_content, list):
+                    # Only pages kept in memory are compressed.
+                    err_headers = list(err_headers)
+                    err_content = [self.compress_response(
+                        err_headers, ''.join(err_content))]
+                    self.logger.update_stats('error_page.bytes',
+                                             len(err_content[0]))
                 start_response(status, err_headers)
                 return err_content
 
@@ -302,19 +1790,17 @@ class Context(object):
             status[:3] + '.html'
         )
 
-        try:
-            with open(local_path, 'r') as f:
-                contents = f.read()
-
+        contents, digest = self.local_files.get(local_path)
+        if contents is not None:
             headers.extend([
                 ('content-type', 'text/html; charset=UTF-8'),
                 ('content-length', str(len(contents))),
+                ('etag', '"%s"' % digest),
             ])
+            contents = self.compress_response(headers, contents)
+            self.logger.update_stats('error_page.bytes', len(contents))
             start_response(status, headers)
-            return contents
-
-        except IOError:
-            pass
+            return [contents]
 
         # No local handler was found. Create a new html page with the status
         # code.
@@ -324,21 +1810,123 @@ class Context(object):
         start_response(status, headers)
         return ["<html><body><h1>", status, "</h1></body></html>"]
 
-    def handle_object(self, start_response, use_preauth):
+    def is_directory(self, use_preauth):
+        """
+        Returns whether the requested object is a pseudo-directory, i.e.
+        whether there are objects below it. The answer is remembered for a
+        short while, or until the container changes.
+        """
+        cache_key = (self.account, self.container, self._get_generation(),
+                     self.obj)
+        found = self.directory_probes.get(cache_key)
+        if found is not None:
+            return found
+
+        # One entry is enough to tell.
+        backend_url = "/v1/%s/%s?format=json&limit=1&prefix=%s" % (
+            self.account, self.container, quote(self.obj + '/', ''))
+
+        status_inner, headers_inner, contents_inner = self.do_internal_get(
+            backend_url, preauthenticate=use_preauth, kind='directory_probe')
+
+        if not 200 <= int(status_inner[:3]) < 300:
+            return False
+
+        found = len(contents_inner) > 2
+        self.directory_probes.set(cache_key, found)
+        return found
+
+    def _web_index_key(self, web_index):
+        return (self.account, self.container, self._get_generation(),
+                self.obj or '', web_index)
+
+    def has_web_index(self, web_index):
+        """
+        Returns whether the requested pseudo-directory (or the container) has
+        an index object. The answer is remembered for a short while, or until
+        the container changes; listings fill it in as well.
+
+        :param web_index: The value of x-container-meta-web-index.
+        """
+        cache_key = self._web_index_key(web_index)
+        found = self.web_indexes.get(cache_key)
+        if found is not None:
+            return found
+
+        # The client's own credentials apply, as they would to the index.
+        status, headers, body = self.make_subrequest(
+            "/v1/%s/%s/%s%s" % (self.account, self.container,
+                                self.obj or '', web_index),
+            method="HEAD", kind='web_index')
+        close_iterable(body)
+
+        if status[:3] == '404':
+            found = False
+        elif 200 <= int(status[:3]) < 300:
+            found = True
+        else:
+            # Let the request for the index itself run into the error.
+            return True
+
+        self.web_indexes.set(cache_key, found)
+        return found
+
+    def _remember_web_index(self, page, limit):
+        """
+        Remembers whether a listing page shows the requested pseudo-directory
+        has an index object, if it covers where the index would be.
+
+        :param page: The page, as returned by read_page().
+        """
+        web_index = self._get_container_info().get('meta', {}).get(
+            'web-index')
+        if not web_index:
+            return
+
+        # Listings are unicode, metadata isn't.
+        name = web_index.decode('utf-8', 'replace')
+        subdirs, files, first, last, count = page
+        found = any(entry.name == name for entry in files)
+
+        if found or count < limit or \
+                last >= (self.obj or '').decode('utf-8', 'replace') + name:
+            self.web_indexes.set(self._web_index_key(web_index), found)
+
+    def run_concurrently(self, *calls):
+        """
+        Runs independent calls, typically making subrequests, at the same
+        time, and returns their results in order. At most
+        subrequest_concurrency calls run at once.
+        """
+        if self.subrequest_concurrency <= 1 or len(calls) <= 1:
+            return [call() for call in calls]
+
+        pile = GreenPile(min(self.subrequest_concurrency, len(calls)))
+        for call in calls:
+            pile.spawn(call)
+
+        return list(pile)
+
+    def pass_on(self, start_response):
+        """
+        Passes the request on to the backend. Only if it fails does the
+        container's metadata matter: missing objects may be
+        pseudo-directories, and errors may get a custom error page.
+        """
         status, contents = self.forward_request()
 
-        if status[0].startswith("404 "):
+        if int(status[0][:3]) < 400:
+            start_response(*status)
+            return contents
+
+        container_info = self._get_container_info().get('meta', {})
+        have_listings, use_preauth = self._listing_mode(container_info)
+
+        if have_listings and self.obj and status[0].startswith("404 "):
             # Object doesn't exist. Try to see if there are any subobjects. If
             # so, redirect to this location with a trailing slash, so it can be
             # treated like a subdirectory.
-            backend_url = "/v1/%s/%s?delimiter=/&format=json&prefix=%s/" % (
-                self.account, self.container, self.obj
-            )
-
-            status_inner, headers_inner, contents_inner = self.do_internal_get(
-                backend_url, preauthenticate=use_preauth)
-
-            if len(contents_inner) > 2:
+            if self.is_directory(use_preauth):
                 # Subobjects were found. treat this like a directory.
                 redirect_to = '/v1/%s/%s/%s/' % (
                     self.account, self.container, self.obj)
@@ -347,78 +1935,843 @@ class Context(object):
                 if qs:
                     redirect_to += "?" + qs
 
+                close_iterable(contents)
                 start_response("302 Found", [("location", redirect_to)])
                 return ""
 
-        start_response(*status)
+        if container_info.get('web-error') or self.want_html:
+            # The error body is replaced, so it's never read.
+            close_iterable(contents)
+            return self.error_response(status[0], status[1], start_response)
 
+        start_response(*status)
         return contents
 
+    def _page_params(self):
+        """
+        Returns the marker, end_marker and limit of the listing page the
+        client asked for. Markers are relative to the listed directory.
+        """
+        params = urlparse.parse_qs(self.env.get('QUERY_STRING', ''))
+        marker = params.get('marker', [''])[0].decode('utf-8', 'replace')
+        end_marker = params.get('end_marker', [''])[0].decode('utf-8',
+                                                              'replace')
+
+        try:
+            limit = min(int(params['limit'][0]), self.listing_page_size)
+        except (KeyError, ValueError):
+            limit = self.listing_page_size
+
+        return marker, end_marker, max(limit, 1)
+
+    def _page_query(self, prefix, marker, end_marker, limit):
+        """
+        Returns the backend query string for a page of a listing. A page
+        with only an end_marker is the page before it, so it's listed in
+        reverse from there.
+        """
+        query = [('limit', str(limit))]
+        if end_marker and not marker:
+            query.append(('reverse', 'true'))
+            query.append(('marker', prefix + end_marker))
+        else:
+            if marker:
+                query.append(('marker', prefix + marker))
+            if end_marker:
+                query.append(('end_marker', prefix + end_marker))
+
+        return '&'.join('%s=%s' % (k, quote(v, '')) for k, v in query)
+
+    def _page_url(self, **changes):
+        """
+        Returns the query string of a neighbouring listing page, keeping
+        any other parameters of the current request.
+        """
+        params = [
+            (k, v) for k, v in urlparse.parse_qsl(
+                self.env.get('QUERY_STRING', ''), keep_blank_values=True)
+            if k not in ('marker', 'end_marker') and k not in changes
+        ]
+        params.extend(sorted(changes.items()))
+
+        return '?' + '&'.join('%s=%s' % (quote(k, ''), quote(v, ''))
+                              for k, v in params)
+
+    def _sort_urls(self, sort, order):
+        """
+        Returns the query strings of the first page of the listing sorted
+        by each field, keeping the filter and limit of the current request.
+        Sorting by the current field again reverses the order.
+        """
+        urls = {}
+        for field in SORT_KEYS:
+            if field == sort:
+                field_order = 'asc' if order == 'desc' else 'desc'
+            else:
+                field_order = 'asc' if field == 'name' else 'desc'
+            urls[field] = self._page_url(sort=field, order=field_order)
+
+        return urls
+
+    def _page_links(self, first, last, count, prefix, marker, end_marker,
+                    limit):
+        """
+        Returns the template variables describing the page of a listing and
+        linking to its neighbours.
+
+        :param first: The full name of the first entry on this page.
+        :param last: The full name of the last entry on this page.
+        :param count: The number of entries listed for this page, which is
+            more than limit for pages before end_marker that aren't the
+            first.
+        :param prefix: The prefix the entry names share.
+        """
+        links = {
+            'marker': marker,
+            'end_marker': end_marker,
+            'limit': limit,
+            'next_marker': None,
+            'prev_marker': None,
+            'next_url': None,
+            'prev_url': None,
+        }
+
+        if not count:
+            if marker or end_marker:
+                # Paged beyond either end; lead back to the first page.
+                links['prev_url'] = self._page_url()
+            return links
+
+        backwards = bool(end_marker and not marker)
+
+        if count >= limit or backwards:
+            links['next_marker'] = last[len(prefix):]
+            links['next_url'] = self._page_url(marker=links['next_marker'])
+
+        # Pages before end_marker are listed with one entry more than they
+        # show; only that tells whether there's a page before them.
+        if marker or (backwards and count > limit):
+            links['prev_marker'] = first[len(prefix):]
+            links['prev_url'] = self._page_url(
+                end_marker=links['prev_marker'])
+
+        return links
+
+    def _view_params(self):
+        """
+        Returns the sort field, sort order and name filter the client asked
+        for, or None if it wants the listing as it is.
+        """
+        params = urlparse.parse_qs(self.env.get('QUERY_STRING', ''))
+        sort = params.get('sort', ['name'])[0]
+        if sort not in SORT_KEYS:
+            sort = 'name'
+        order = 'desc' if params.get('order', [''])[0] == 'desc' else 'asc'
+        name_filter = params.get('filter', [''])[0].decode('utf-8', 'replace')
+
+        if sort == 'name' and order == 'asc' and not name_filter:
+            return None
+
+        return sort, order, name_filter
+
+    def walk_view(self, body, prefix, marker, limit, view, use_preauth):
+        """
+        Walks a container listing, starting with the first page in body, and
+        keeps only what a sorted or filtered view shows: the first limit
+        matches in name order, or else the top limit matches. Memory use is
+        bounded by limit, however large the container is.
+
+        :returns: the subdirs and files, the full names of the first and last
+            entry, and the number of entries.
+        """
+        sort, order, name_filter = view
+
+        walk = self.iter_listing(prefix, marker, '', use_preauth,
+                                 iter_json_array(body))
+        entries = walk
+
+        if name_filter:
+            needle = name_filter.lower()
+            if needle.startswith('*.'):
+                def matches(name):
+                    return name.lower().endswith(needle[1:])
+            else:
+                def matches(name):
+                    return needle in name.lower()
+
+            entries = (
+                item for item in walk
+                if matches(SORT_KEYS['name'](item)[len(prefix):]))
+
+        try:
+            if sort == 'name' and order == 'asc':
+                # The listing is in this order already; stop once we've got
+                # enough.
+                kept = list(itertools.islice(entries, limit))
+            elif order == 'asc':
+                kept = heapq.nsmallest(limit, entries, key=SORT_KEYS[sort])
+            else:
+                kept = heapq.nlargest(limit, entries, key=SORT_KEYS[sort])
+        finally:
+            walk.close()
+            close_iterable(body)
+
+        subdirs = [
+            SubdirEntry(item, prefix) for item in kept if 'subdir' in item]
+        files = [
+            FileEntry(item, prefix) for item in kept if 'subdir' not in item]
+
+        if not kept:
+            return subdirs, files, None, None, 0
+
+        return subdirs, files, SORT_KEYS['name'](kept[0]), \
+            SORT_KEYS['name'](kept[-1]), len(kept)
+
+    def read_page(self, body, prefix, backwards, limit=None):
+        """
+        Reads a page of a container listing, sorting its entries into subdirs
+        and files while they're parsed.
+
+        :param backwards: Whether the page was listed in reverse.
+        :param limit: The number of entries on the page; entries beyond it
+            are counted, but left out.
+        :returns: the subdirs and files, the full names of the first and last
+            entry, and the number of entries listed.
+        """
+        subdirs = []
+        files = []
+        first = last = None
+        count = 0
+        try:
+            for item in iter_json_array(body):
+                if limit and count >= limit:
+                    count += 1
+                    continue
+
+                if 'subdir' in item:
+                    subdirs.append(SubdirEntry(item, prefix))
+                    last = item['subdir']
+                else:
+                    files.append(FileEntry(item, prefix))
+                    last = item['name']
+
+                if first is None:
+                    first = last
+                count += 1
+        finally:
+            close_iterable(body)
+
+        if backwards:
+            subdirs.reverse()
+            files.reverse()
+            first, last = last, first
+
+        return subdirs, files, first, last, count
+
+    def head_container(self, start_response, use_preauth):
+        """
+        Answers a HEAD request for a listing from the container's info and
+        the caches, without fetching or rendering the listing. Only a
+        rendered listing that's cached already gives a Content-Length.
+        """
+        is_public = self._listing_is_public(use_preauth)
+
+        if not is_public:
+            # A container HEAD checks the client may see the listing, like
+            # the listing subrequest would.
+            status, headers, body = self.make_subrequest(
+                "/v1/%s/%s" % (self.account, self.container),
+                method="HEAD", kind='listing')
+            close_iterable(body)
+            if not 200 <= int(status[:3]) < 300:
+                start_response(status, headers)
+                return [""]
+
+        template, template_version, error = self.load_template()
+        if error:
+            close_iterable(error[2])
+            start_response(error[0], error[1])
+            return [""]
+
+        self.listing_headers = self._listing_validators(template_version)
+        if self._is_not_modified(self.listing_headers):
+            return self.not_modified_response(self.listing_headers,
+                                              start_response)
+
+        if self._cache and not self.stream_listings and is_public:
+            cache_key = self._listing_cache_key(template_version)
+            html = cache_key and self._cache.get(cache_key)
+            if html is not None:
+                self.logger.increment('listing_cache.hit')
+                # Response leaves out the body of HEAD requests.
+                return self.listing_response(html, start_response, cache_key)
+            self.logger.increment('listing_cache.miss')
+
+        headers = dict(self.listing_headers)
+        headers['Content-Type'] = 'text/html; charset=UTF-8'
+        start_response('200 OK', headers.items())
+        return [""]
+
     def handle_container(self, start_response, use_preauth):
-        backend_url = "/v1/%s/%s?delimiter=/&format=json" % (
+        if self.env['REQUEST_METHOD'] == 'HEAD':
+            return self.head_container(start_response, use_preauth)
+
+        is_public = self._listing_is_public(use_preauth)
+        marker, end_marker, limit = self._page_params()
+        # Entry names in listings are unicode, so the prefix sliced off them
+        # and the markers added to it are too.
+        prefix = (self.obj or '').decode('utf-8', 'replace')
+        page_size = limit
+
+        if end_marker and not marker and self.listing_page_size > 1:
+            # Pages before end_marker are listed with one entry more, which
+            # shows whether there's a page before them in turn.
+            limit = min(limit, self.listing_page_size - 1)
+            page_size = limit + 1
+
+        view = None
+        if self.stream_listings:
+            # Fetch the first page before responding, so errors can still be
+            # forwarded.
+            limit = page_size = self.listing_page_size
+            end_marker = end_marker if marker else ''
+        else:
+            view = self._view_params()
+
+        if view:
+            # Views walk the listing from the start, or from marker when
+            # they're in name order, a full page at a time.
+            if view[:2] != ('name', 'asc'):
+                marker = ''
+            end_marker = ''
+            page_size = self.listing_page_size
+
+        def fetch_listing():
+            return self.make_subrequest(
+                self._listing_url(prefix, marker, end_marker, page_size),
+                preauthenticate=use_preauth, kind='listing')
+
+        if is_public or view:
+            # The listing may not be needed at all if it's cached or the
+            # client has it already, which depends on the template.
+            listing = None
+            template, template_version, error = self.load_template()
+        else:
+            # The listing is needed anyway, so fetch it while the template
+            # is resolved.
+            (template, template_version, error), listing = \
+                self.run_concurrently(self.load_template, fetch_listing)
+
+        if error and (listing is None or
+                      200 <= int(listing[0][:3]) < 300):
+            if listing is not None:
+                close_iterable(listing[2])
+            start_response(error[0], error[1])
+            return error[2]
+
+        self.listing_headers = self._listing_validators(template_version)
+
+        # The listing subrequest is what checks the client may see the
+        # listing; only skip it if anyone may.
+        if is_public and self._is_not_modified(self.listing_headers):
+            return self.not_modified_response(self.listing_headers,
+                                              start_response)
+
+        # Listings that anyone may see are rendered once per container
+        # generation and template, unless they're streamed.
+        cache_key = None
+        if self._cache and not self.stream_listings and is_public:
+            cache_key = self._listing_cache_key(template_version)
+            html = cache_key and self._cache.get(cache_key)
+            if html is not None:
+                self.logger.increment('listing_cache.hit')
+                return self.listing_response(html, start_response, cache_key)
+            self.logger.increment('listing_cache.miss')
+
+        container_info = self._get_container_info()
+
+        context = {
+            'meta': dict(
+                (k.replace('-', '_'), v)
+                for (k, v) in container_info.get('meta', {}).items()),
+            'prefix': prefix,
+            'path': (self.env.get('HTTP_ORIGINAL_PATH') or
+                     self.env['PATH_INFO']).decode('utf-8', 'replace'),
+            'sort': view[0] if view else 'name',
+            'order': view[1] if view else 'asc',
+            'filter': view[2] if view else '',
+        }
+
+        if self.stream_listings:
+            status, headers, body = listing or fetch_listing()
+
+            if not 200 <= int(status[:3]) < 300:
+                start_response(status, headers)
+                return body
+
+            if self._is_not_modified(self.listing_headers):
+                close_iterable(body)
+                return self.not_modified_response(self.listing_headers,
+                                                  start_response)
+
+            # Every walk from the start starts with the first page, so keep
+            # it.
+            try:
+                page = list(iter_json_array(body))
+            finally:
+                close_iterable(body)
+
+            def walk(after=None):
+                if after is None:
+                    return self.iter_listing(prefix, marker, end_marker,
+                                             use_preauth, page)
+                return self.iter_listing(prefix, after, end_marker,
+                                         use_preauth)
+
+            shared = ListingWalk(walk, prefix, self.listing_page_size)
+            context['subdirs'] = ListingStream(
+                shared, 'subdir', SubdirEntry, prefix)
+            context['files'] = ListingStream(
+                shared, 'name', FileEntry, prefix)
+            context.update(self._page_links(
+                None, None, 0, prefix, '', '', limit))
+
+            return self.stream_listing(context, start_response, template)
+
+        # Views of public listings are kept per container generation.
+        view_key = None
+        if view and is_public:
+            view_key = (self.account, self.container, self._get_generation(),
+                        prefix, marker, limit) + view
+
+        def build():
+            """
+            Fetches and renders the listing, returning the rendered listing
+            or the status, headers and body to respond with instead.
+            """
+            page = view_key and self.listing_views.get(view_key)
+
+            if page is None:
+                status, headers, body = listing or fetch_listing()
+
+                if not 200 <= int(status[:3]) < 300:
+                    return status, headers, body
+
+                if self._is_not_modified(self.listing_headers):
+                    close_iterable(body)
+                    return '304 Not Modified', self.listing_headers.items(), \
+                        [""]
+
+                if view:
+                    page = self.walk_view(body, prefix, marker, limit, view,
+                                          use_preauth)
+                    if view_key and not self.walk_failed:
+                        self.listing_views.set(view_key, page)
+                else:
+                    page = self.read_page(body, prefix,
+                                          bool(end_marker and not marker),
+                                          limit)
+                    if not (marker or end_marker):
+                        self._remember_web_index(page, limit)
+
+            subdirs, files, first, last, count = page
+            page_context = dict(context, subdirs=subdirs, files=files)
+
+            if view and view[:2] != ('name', 'asc'):
+                # Sorted views show only the top of the listing.
+                first = last = None
+                count = 0
+            links = self._page_links(
+                first, last, count, prefix, marker, end_marker, limit)
+            if view and links['prev_url']:
+                # Filtered views can't be walked backwards; lead back to the
+                # first page instead.
+                links['prev_marker'] = None
+                links['prev_url'] = self._page_url()
+            page_context.update(links)
+
+            return self.render_listing(page_context, template, cache_key)
+
+        if is_public:
+            # Concurrent requests for the same public listing share a single
+            # fetch and render. Responses other than the rendered listing
+            # can't be shared; each request makes its own.
+            responses = []
+
+            def build_shared():
+                result = build()
+                if isinstance(result, tuple):
+                    responses.append(result)
+                    return None
+                return result
+
+            result = self.flights.run(
+                ('listing', self.account, self.container,
+                 self._get_generation(),
+                 self._listing_variant(template_version)),
+                build_shared)
+            if result is None:
+                result = responses[0]
+        else:
+            result = build()
+
+        if isinstance(result, tuple):
+            start_response(result[0], result[1])
+            return result[2]
+
+        return self.listing_response(result, start_response, cache_key)
+
+    def _listing_url(self, prefix, marker, end_marker, limit,
+                     delimiter='/'):
+        """
+        Returns the backend url of a page of the current container's listing.
+
+        :param delimiter: The delimiter rolling objects up into
+            pseudo-directories, or None to list every object.
+        """
+        backend_url = "/v1/%s/%s?%sformat=json&%s" % (
             self.account,
-            self.container
+            self.container,
+            ('delimiter=%s&' % quote(delimiter)) if delimiter else '',
+            self._page_query(prefix, marker, end_marker, limit),
         )
-        if self.obj:
-            backend_url += "&prefix=" + self.obj
+        if prefix:
+            backend_url += "&prefix=" + quote(prefix, '')
 
-        status, headers, content = self.do_internal_get(
-            backend_url, preauthenticate=use_preauth)
+        return backend_url
 
-        if 200 <= int(status[:3]) < 300:
-            content = json.loads(content)
+    def iter_listing(self, prefix, marker, end_marker, use_preauth,
+                     page=None, delimiter='/'):
+        """
+        Yields the entries of the container listing after marker, fetching it
+        one page at a time. A failing page ends the listing, as the response
+        has started by the time it's fetched; walk_failed tells it apart from
+        the actual end.
+
+        :param page: The first page, if it was fetched already.
+        :param delimiter: The delimiter of the listing, or None to list every
+            object.
+        """
+        limit = self.listing_page_size
+
+        while True:
+            body = None
+            if page is None:
+                status, headers, body = self.make_subrequest(
+                    self._listing_url(prefix, marker, end_marker, limit,
+                                      delimiter),
+                    preauthenticate=use_preauth, kind='listing')
+                if not 200 <= int(status[:3]) < 300:
+                    close_iterable(body)
+                    self.walk_failed = True
+                    self.logger.increment('listing.walk_failed')
+                    return
+                page = iter_json_array(body)
+
+            count = 0
+            last = None
+            try:
+                for item in page:
+                    count += 1
+                    last = item.get('subdir') or item.get('name')
+                    yield item
+            finally:
+                close_iterable(body)
 
-            container_info = self._get_container_info()
+            if count < limit:
+                return
 
-            context = {
-                'meta': dict(
-                    (k.replace('-', '_'), v)
-                    for (k, v) in container_info.get('meta', {}).items()),
-                'prefix': self.obj,
-                'path': self.env.get('HTTP_ORIGINAL_PATH') or self.env['PATH_INFO'],
-                'subdirs': [item for item in content if 'subdir' in item],
-                'files': [item for item in content if 'name' in item],
-            }
+            marker = last[len(prefix):]
+            page = None
 
-            #
-            if self.obj:
-                for subdir in context['subdirs']:
-                    subdir['subdir'] = subdir['subdir'][len(self.obj):]
-                for fil in context['files']:
-                    fil['name'] = fil['name'][len(self.obj):]
+    def _site_url(self):
+        """
+        Returns the scheme and host the client made the request to.
+        """
+        return '%s://%s' % (
+            self.env.get('wsgi.url_scheme', 'http'),
+            self.env.get('HTTP_HOST') or self.env.get('SERVER_NAME'))
+
+    def iter_index(self, entries, index_format, prefix):
+        """
+        Yields a sitemap or flat JSON index of the given listing entries, in
+        pieces.
+        """
+        path = self.env.get('HTTP_ORIGINAL_PATH') or self.env['PATH_INFO']
+        if not path.endswith('/'):
+            path += '/'
+
+        base_url = self._site_url() + quote(path)
+
+        if index_format == 'sitemapindex':
+            # Every part lists the URLs after the last one of the part
+            # before it.
+            yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<sitemapindex xmlns="http://www.sitemaps.org/schemas/'
+                   'sitemap/0.9">\n')
+            marker = ''
+            for count, item in enumerate(entries):
+                if not count % SITEMAP_MAX_URLS:
+                    yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(
+                        '%s?format=sitemap&marker=%s' % (
+                            base_url, quote(marker, '')))
+                marker = item['name'][len(prefix):]
+            yield '</sitemapindex>\n'
+
+        elif index_format == 'sitemap':
+            yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<urlset xmlns="http://www.sitemaps.org/schemas/'
+                   'sitemap/0.9">\n')
+            for item in itertools.islice(entries, SITEMAP_MAX_URLS):
+                url = '<url><loc>%s</loc>' % escape(
+                    base_url + quote(item['name'][len(prefix):]))
+                if item.get('last_modified'):
+                    url += '<lastmod>%sZ</lastmod>' % \
+                        item['last_modified'][:19]
+                yield url + '</url>\n'
+            yield '</urlset>\n'
 
-            return self.mklisting(context, start_response)
         else:
+            separator = '[\n'
+            for item in entries:
+                yield separator + json.dumps(item)
+                separator = ',\n'
+            yield '[]\n' if separator == '[\n' else '\n]\n'
+
+    def handle_index(self, start_response, index_format):
+        """
+        Sends a sitemap or flat JSON index of every object in the container,
+        or below the requested pseudo-directory. It's built from a single
+        walk of the listing without a delimiter, and streamed; indexes of
+        public listings that are small enough are kept in memcache for the
+        current container generation.
+
+        :param index_format: One of INDEX_FORMATS.
+        """
+        container_info = self._get_container_info().get('meta', {})
+        listings = container_info.get('web-listings', 'auto').lower()
+
+        if listings in ('false', 'no', '0', 'off') or (
+                self.obj and not self.obj.endswith('/')):
+            return self.app(self.env, start_response)
 
+        use_preauth = listings in ('true', 'yes', '1', 'on')
+        is_public = self._listing_is_public(use_preauth)
+        prefix = (self.obj or '').decode('utf-8', 'replace')
+        content_type = INDEX_FORMATS[index_format]
+
+        # Sitemaps of containers with more objects than a sitemap may hold
+        # become an index of sitemaps, each listing its part of the
+        # container from a marker.
+        params = urlparse.parse_qs(self.env.get('QUERY_STRING', ''),
+                                   keep_blank_values=True)
+        marker = ''
+        if index_format == 'sitemap':
+            if 'marker' in params:
+                marker = params['marker'][0].decode('utf-8', 'replace')
+            elif int(self._get_container_info().get('object_count') or 0) \
+                    > SITEMAP_MAX_URLS:
+                index_format = 'sitemapindex'
+
+        # Sitemaps hold absolute URLs, so they differ per host they're
+        # requested through.
+        variant = 'index:' + index_format
+        if index_format != 'index':
+            variant += ':' + self._site_url()
+
+        self.listing_headers = self._listing_validators(variant)
+
+        # The listing subrequest is what checks the client may see the
+        # index; only skip it if anyone may.
+        if is_public and self._is_not_modified(self.listing_headers):
+            return self.not_modified_response(self.listing_headers,
+                                              start_response)
+
+        cache_key = None
+        if self._cache and is_public:
+            cache_key = self._listing_cache_key(variant)
+            index = cache_key and self._cache.get(cache_key)
+            if index is not None:
+                self.logger.increment('index_cache.hit')
+                return self.listing_response(index, start_response,
+                                             cache_key, content_type)
+            self.logger.increment('index_cache.miss')
+
+        status, headers, body = self.make_subrequest(
+            self._listing_url(prefix, marker, '', self.listing_page_size,
+                              None),
+            preauthenticate=use_preauth, kind='listing')
+
+        if not 200 <= int(status[:3]) < 300:
             start_response(status, headers)
-            return [content]
+            return body
+
+        if self._is_not_modified(self.listing_headers):
+            close_iterable(body)
+            return self.not_modified_response(self.listing_headers,
+                                              start_response)
+
+        try:
+            page = list(iter_json_array(body))
+        finally:
+            close_iterable(body)
+
+        def generate():
+            walk = self.iter_listing(prefix, marker, '', use_preauth, page,
+                                     delimiter=None)
+            kept = []
+            size = 0
+            try:
+                for piece in self.iter_index(walk, index_format, prefix):
+                    if kept is not None:
+                        kept.append(piece)
+                        size += len(piece)
+                        if size > MAX_CACHED_INDEX:
+                            kept = None
+                    yield piece
+            finally:
+                # Sitemaps may end before the walk does.
+                close_iterable(walk)
+
+            if cache_key and kept is not None and not self.walk_failed:
+                self._cache.set(cache_key, ''.join(kept), serialize=False,
+                                time=self.cache_timeout)
+
+        return self.stream_response(generate(), content_type, start_response)
 
     def handle_account(self, start_response):
-        status, headers, content = self.do_internal_get(
-            "/v1/%s?format=json" % self.account
+        marker, end_marker, limit = self._page_params()
+        backwards = bool(end_marker and not marker)
+
+        page_size = limit
+        if backwards and self.listing_page_size > 1:
+            # See handle_container.
+            limit = min(limit, self.listing_page_size - 1)
+            page_size = limit + 1
+
+        status, headers, body = self.make_subrequest(
+            "/v1/%s?format=json&%s" % (
+                self.account,
+                self._page_query('', marker, end_marker, page_size)),
+            kind='listing'
         )
 
         if 200 <= int(status[:3]) < 300:
-            content = json.loads(content)
+            try:
+                subdirs = [SubdirEntry(item) for item in iter_json_array(body)]
+            finally:
+                close_iterable(body)
+
+            count = len(subdirs)
+            if backwards:
+                del subdirs[limit:]
+                subdirs.reverse()
 
             context = {
                 'meta': {},
                 'prefix': '',
                 'path': '/',
-                'subdirs': content,
+                'subdirs': subdirs,
                 'files': [],
             }
+            context.update(self._page_links(
+                subdirs and subdirs[0].name, subdirs and subdirs[-1].name,
+                count, '', marker, end_marker, limit))
 
             return self.mklisting(context, start_response)
         else:
             start_response(status, headers)
-            return [content]
+            return body
 
-    def mklisting(self, listing, start_response):
+    def fetch_template(self, template_path):
+        """
+        Fetches a listing template from a container. Templates fetched
+        earlier are reused for cache_timeout seconds, after which they're
+        revalidated with a conditional request.
+
+        :param template_path: The swift path of the template object.
+        :returns: a tuple of status, headers, body and a version string
+            identifying the template source. The body is None if the
+            template is larger than MAX_TEMPLATE_SIZE.
+        """
+        cached = self.remote_templates.get(template_path)
+        if cached and cached['checked'] + self.cache_timeout > time.time():
+            return '200 OK', cached['headers'], cached['body'], \
+                cached['version']
+
+        conditions = {}
+        if cached:
+            if cached['etag']:
+                conditions['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                conditions['If-Modified-Since'] = cached['last_modified']
+
+        def fetch():
+            # TODO: ponder whether this should be preauthenticated
+            status, headers, body = self.make_subrequest(
+                template_path, headers=conditions, kind='template')
+            if status[0] != '2':
+                return status, headers, body
+
+            length = dict((k.lower(), v) for k, v in headers).get(
+                'content-length')
+            if length is not None and int(length) > MAX_TEMPLATE_SIZE:
+                close_iterable(body)
+                return status, headers, None
+
+            # Read no further than the limit if the length isn't known.
+            chunks = []
+            size = 0
+            try:
+                for chunk in body:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > MAX_TEMPLATE_SIZE:
+                        return status, headers, None
+            finally:
+                close_iterable(body)
+
+            self.logger.update_stats('buffered_bytes', size)
+            return status, headers, ''.join(chunks)
+
+        status, headers, answer = self.flights.run(
+            ('template', template_path, tuple(sorted(conditions.items()))),
+            fetch)
+
+        if cached and status[:3] == '304':
+            cached['checked'] = time.time()
+            return '200 OK', cached['headers'], cached['body'], \
+                cached['version']
+
+        if status[0] != '2' or answer is None:
+            self.remote_templates.delete(template_path)
+            return status, headers, answer, None
+
+        header_dict = dict((k.lower(), v) for k, v in headers)
+        etag = header_dict.get('etag')
+        cached = {
+            'checked': time.time(),
+            'headers': headers,
+            'body': answer,
+            'etag': etag,
+            'last_modified': header_dict.get('last-modified'),
+            'version': ('etag:' + etag.strip('"')) if etag
+            else md5(answer).hexdigest(),
+        }
+        self.remote_templates.set(template_path, cached)
+
+        return status, headers, answer, cached['version']
+
+    def load_template(self):
+        """
+        Resolves the listing template for the current container.
 
+        :returns: a tuple of the compiled template, a string identifying its
+            version, and the status, headers and body of a failed template
+            fetch (or None).
+        """
         container_info = self._get_container_info().get('meta', {})
 
-        # Load the template
         template_name = container_info.get('web-listings-template')
 
         if template_name and template_name != '-':
@@ -428,56 +2781,226 @@ class Context(object):
                 template_path = "/v1/%s/%s/%s" % (
                     self.account, self.container, template_name)
 
-            # TODO: ponder whether this should be preauthenticated
-            status, headers, answer = self.do_internal_get(template_path)
-            if status[0] == '2':
-                template = answer
-            else:
+            status, headers, answer, version = self.fetch_template(
+                template_path)
+            if status[0] != '2':
                 # Forward any errors.
-                start_response(status, headers)
-                return answer
+                return None, None, (status, headers, answer)
+
+            if answer is None:
+                self.template_violation(
+                    'larger than %d bytes' % MAX_TEMPLATE_SIZE)
+                return self.local_template()
+
+            # Containers' templates are rendered in the sandbox.
+            return self._compile_template('container:' + template_path,
+                                          answer, version, self.sandbox)
+
+        return self.local_template()
+
+    def local_template(self):
+        """
+        Resolves the listing template from template_path, or the default
+        one. Unlike the templates of containers, these are trusted.
+
+        :returns: the same as load_template().
+        """
+        local_path = os.path.join(
+            self.conf.get('template_path', __file__),
+            "index.html")
+
+        source, version = self.local_files.get(local_path)
+        if source is not None:
+            origin = 'local:' + local_path
+        else:
+            origin = version = 'default'
+            source = default_template
+
+        return self._compile_template(origin, source, version)
+
+    def _compile_template(self, origin, source, version, environment=None):
+        started = time.time()
+        misses = self.template_cache.misses
+        template = self.template_cache.get_template(
+            origin, source, environment or self.environment, version)
+        if self.template_cache.misses != misses:
+            self.record_timing('template.compile', started)
+
+        return template, origin + '@' + version, None
+
+    def generate_template(self, template, context):
+        """
+        Returns an iterator over the output of a template, which keeps to
+        the render budget if the template is sandboxed.
+        """
+        if isinstance(template.environment, BudgetedEnvironment):
+            return template.environment.generate(template, context)
+
+        return template.generate(context)
+
+    def template_violation(self, error):
+        """
+        Counts and logs a container's template breaking the sandbox or
+        exceeding its render budget.
+        """
+        self.logger.increment('template.violation')
+        self.logger.warning('Listing template of /%s/%s rejected: %s',
+                            self.account, self.container, error)
+
+    def listing_response(self, html, start_response, cache_key=None,
+                         content_type='text/html; charset=UTF-8'):
+        """
+        Sends a rendered listing to the remote client, compressed if it
+        accepts that. Listings without validators of their own get an ETag
+        from their contents.
+
+        :param cache_key: The memcache key the listing is stored under, if
+            any. Its compressed variant is stored alongside it.
+        """
+        body = html.encode('utf-8') if isinstance(html, unicode) else html
+
+        headers = dict(self.listing_headers)
+        if 'ETag' not in headers:
+            headers['ETag'] = self.encoded_etag(
+                '"%s"' % md5(body).hexdigest())
+            headers['Vary'] = 'Accept-Encoding'
+
+        if self._is_not_modified(headers):
+            return self.not_modified_response(headers, start_response)
+
+        if self.encoding and len(body) >= self.compress_min_size:
+            compressed_key = cache_key and '%s/%s' % (cache_key, self.encoding)
+            compressed = compressed_key and self._cache.get(compressed_key)
+            if not compressed:
+                started = time.time()
+                compressed = compress(body, self.encoding,
+                                      self.compress_level)
+                self.record_timing('compress', started)
+                if compressed_key:
+                    self._cache.set(compressed_key, compressed,
+                                    serialize=False, time=self.cache_timeout)
+
+            body = compressed
+            headers['Content-Encoding'] = self.encoding
+
+        headers['Content-Type'] = content_type
+        self.logger.update_stats('listing.bytes', len(body))
+        resp = Response(headers=headers, body=body)
+        return resp(self.env, start_response)
+
+    def mklisting(self, listing, start_response, template_engine=None,
+                  cache_key=None):
+        """
+        Renders a listing and sends it to the remote client.
+
+        :param listing: The template context.
+        :param start_response: The WSGI start_response hook.
+        :param template_engine: The compiled template, if it was resolved
+            already.
+        :param cache_key: The memcache key to store the rendered listing
+            under, if it may be reused.
+        """
+        if template_engine is None:
+            template_engine, _version, error = self.load_template()
+            if error:
+                start_response(error[0], error[1])
+                return error[2]
+
+        html = self.render_listing(listing, template_engine, cache_key)
+        return self.listing_response(html, start_response, cache_key)
+
+    def render_listing(self, listing, template_engine, cache_key=None):
+        """
+        Renders a listing, storing it in memcache under cache_key if given.
+        """
+        self._complete_listing(listing)
 
+        started = time.time()
+        try:
+            try:
+                html = u''.join(
+                    self.generate_template(template_engine, listing))
+            except SecurityError, e:
+                # Fall back to a template we trust.
+                self.template_violation(e)
+                html = self.local_template()[0].render(listing)
+        except Exception, e:
+            html = "Could not generate listing<br> %s" % str(e)
         else:
-            template = default_template
+            if cache_key:
+                self._cache.set(cache_key, html, time=self.cache_timeout)
+        self.record_timing('template.render', started)
+
+        return html
 
-            # Try to find a local handler.
-            local_path = os.path.join(
-                self.conf.get('template_path', __file__),
-                "index.html")
+    def stream_listing(self, listing, start_response, template_engine):
+        """
+        Renders a listing while sending it to the remote client, so the
+        listing never has to be held in memory as a whole.
+        """
+        self._complete_listing(listing)
 
+        def generate():
             try:
-                with open(local_path, 'r') as f:
-                    template = f.read()
-            except IOError:
-                pass
-
-        for subdir in listing['subdirs']:
-            if 'bytes' in subdir:
-                subdir['size'] = human_readable(subdir['bytes'])
-                subdir['size_num'], subdir[
-                    'size_unit'] = human_readable_size(subdir['bytes'])
-
-            subdir.setdefault('subdir', subdir.get('name'))
-
-        for fil in listing['files']:
-            fil['size'] = human_readable(fil['bytes'])
-            fil['size_num'], fil[
-                'size_unit'] = human_readable_size(fil['bytes'])
-            fil['date'] = fil['last_modified']
-            fil['type_classes'] = " ".join(
-                ('type-%s' % t.replace(".", '-'))
-                for t in fil['content_type'].split('/'))
-            if '.' in fil['name']:
-                fil['type_classes'] += " ext-" + fil['name'].rsplit('.', 1)[-1]
-
-        headers = {'Content-Type': 'text/html; charset=UTF-8'}
-
-        template_engine = jinja2.Template(template)
+                for chunk in self.generate_template(template_engine, listing):
+                    yield chunk.encode('utf-8')
+            except SecurityError, e:
+                # Part of the listing was sent already, so it's too late to
+                # fall back to another template.
+                self.template_violation(e)
+                yield "Could not generate listing<br> %s" % str(e)
+            except Exception, e:
+                yield "Could not generate listing<br> %s" % str(e)
+
+        return self.stream_response(generate(), 'text/html; charset=UTF-8',
+                                    start_response)
+
+    def stream_response(self, chunks, content_type, start_response):
+        """
+        Sends a generated response to the remote client while it's being
+        generated, in chunks of about 64KB, compressed if it accepts that.
+        """
+        def generate():
+            buffered = []
+            size = 0
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= 65536:
+                    yield ''.join(buffered)
+                    buffered = []
+                    size = 0
+
+            yield ''.join(buffered)
+
+        def generate_compressed():
+            compressor = make_compressor(self.encoding, self.compress_level)
+
+            for chunk in generate():
+                # Flush every chunk, so the client can show it right away.
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+
+        headers = dict(self.listing_headers)
+        headers['Content-Type'] = content_type
+        if self.encoding:
+            headers['Content-Encoding'] = self.encoding
+            resp = Response(headers=headers, app_iter=generate_compressed())
+        else:
+            resp = Response(headers=headers, app_iter=generate())
+        return resp(self.env, start_response)
 
+    def _complete_listing(self, listing):
+        """
+        Adds the template variables every listing has to its context.
+        """
         listing.setdefault('at_root', listing['path'].count('/') <= 1)
         listing.setdefault('account', self.account)
         listing.setdefault('container', self.container)
         listing.setdefault('object', self.obj)
+        listing.setdefault('sort_urls', self._sort_urls(
+            listing.get('sort', 'name'), listing.get('order', 'asc')))
 
         listing.setdefault('powered', self.conf.get("powered", ''))
         listing.setdefault('authenticated', any(
@@ -485,14 +3008,6 @@ class Context(object):
             ['HTTP_AUTHORIZATION', 'HTTP_X_AUTH_TOKEN'])
         )
 
-        try:
-            html = template_engine.render(listing)
-        except Exception, e:
-            html = "Could not generate listing<br> %s" % str(e)
-
-        resp = Response(headers=headers, body=html)
-        return resp(self.env, start_response)
-
     def __call__(self, env, start_response):
         """
         Main hook into the WSGI paste.deploy filter/app pipeline.
@@ -508,6 +3023,29 @@ class Context(object):
                                 'HTTP_X_STORAGE_USER', 'HTTP_X_AUTH_USER')
         )
 
+        if self.timing_header_key and streq_const_time(
+                env.get('HTTP_X_STATICWEB_TIMING', ''),
+                self.timing_header_key):
+            send_response = start_response
+
+            def start_response(status, headers, exc_info=None):
+                headers = list(headers)
+                headers.append(
+                    ('X-Staticweb-Timing', self.timing_header_value()))
+                return send_response(status, headers, exc_info)
+
+        index_format = urlparse.parse_qs(
+            env.get('QUERY_STRING', '')).get('format', [''])[0]
+        self.index_format = index_format if (
+            self.indexes and self.container and
+            index_format in INDEX_FORMATS) else None
+
+        # Objects, and API requests that won't get a listing, are passed on
+        # without looking at the container's metadata, unless they fail.
+        if not env['PATH_INFO'].endswith('/') and not self.index_format and \
+                (self.obj or (self.is_authenticated and not self.want_html)):
+            return self.pass_on(start_response)
+
         container_info = self._get_container_info().get('meta', {})
 
         if not container_info.get('web-error') and not self.want_html:
@@ -517,23 +3055,11 @@ class Context(object):
 
         self.env = env
 
-        found_status = []
-
-        def catch_status(status, headers, exc_info=None):
-            found_status.extend((status, headers))
-            if exc_info:
-                found_status.append(exc_info)
-
-        answer = self.dispatch(catch_status)
-
-        if not found_status:
-            it = iter(answer)
-            first = it.next()
-            answer = itertools.chain([first], it)
-
-        assert found_status
+        found_status, answer = self.capture_response(self.dispatch)
 
         if int(found_status[0][:3]) >= 400:
+            # The error body is replaced, so it's never read.
+            close_iterable(answer)
             return self.error_response(found_status[0], found_status[1],
                                        start_response)
 
@@ -543,10 +3069,19 @@ class Context(object):
 
     def dispatch(self, start_response):
         container_info = self._get_container_info().get('meta', {})
+
+        if self.index_format:
+            return self.handle_index(start_response, self.index_format)
+
+        have_listings, use_preauth = self._listing_mode(container_info)
+
         if self.container:
             if self.env['PATH_INFO'].endswith('/'):
                 web_index = container_info.get('web-index')
-                if web_index:
+                # Without a listing to show instead, a missing index is
+                # still a 404, so there's no need to check for it.
+                if web_index and (not have_listings or
+                                  self.has_web_index(web_index)):
                     tmp_env = dict(self.env)
                     tmp_env['PATH_INFO'] += web_index
                     return self.app(tmp_env, start_response)
@@ -559,31 +3094,33 @@ class Context(object):
                 start_response("302 Found", [("location", redirect_to)])
                 return ""
 
-        # if listings are explicitly enabled or disabled, follow that
-        listings = container_info.get('web-listings', 'auto').lower()
-
-        if listings in ('false', 'no', '0', 'off'):
-            have_listings = False
-            use_preauth = False
-        elif listings in ('true', 'yes', '1', 'on'):
-            have_listings = self.want_html if self.is_authenticated else True
-            use_preauth = True
-        else:
-            have_listings = self.want_html
-            use_preauth = False
-
         # don't bother creating an html-index if the client doesn't like HTML
         # in the first place.
         if have_listings:
-            if self.obj and not self.obj.endswith('/'):
-                return self.handle_object(start_response, use_preauth)
-            elif self.container:
+            if self.container:
                 return self.handle_container(start_response, use_preauth)
             else:
                 return self.handle_account(start_response)
         else:
             return self.app(self.env, start_response)
 
+    def _listing_mode(self, container_info):
+        """
+        Returns whether the client gets a listing, and whether the listing
+        subrequests are preauthenticated.
+
+        :param container_info: The container's x-container-meta-* headers.
+        """
+        # if listings are explicitly enabled or disabled, follow that
+        listings = container_info.get('web-listings', 'auto').lower()
+
+        if listings in ('false', 'no', '0', 'off'):
+            return False, False
+        elif listings in ('true', 'yes', '1', 'on'):
+            return (self.want_html if self.is_authenticated else True), True
+        else:
+            return self.want_html, False
+
 
 def filter_factory(global_conf, **local_conf):
     """ Returns a Static Web WSGI filter for use with paste.deploy. """
@@ -0,0 +1,864 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 CloudVPS
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests better_staticweb against the stand-ins for swift and memcache that
+benchmark.py uses. Run them from a checkout, with swift, jinja2 and
+eventlet installed:
+
+    python -m unittest test_better_staticweb
+"""
+
+import json
+import os
+import re
+import time
+import unittest
+import zlib
+from StringIO import StringIO
+
+import eventlet
+
+import better_staticweb
+from benchmark import ACCOUNT, FakeMemcache, FakeSwift
+
+
+class TrackedBody(object):
+    """
+    A response body that keeps track of whether it was closed.
+    """
+
+    def __init__(self, body, unclosed):
+        self.body = body
+        self.unclosed = unclosed
+        unclosed.add(self)
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        self.unclosed.discard(self)
+
+
+class RecordingSwift(FakeSwift):
+    """
+    A FakeSwift that records the requests made to it, and whose containers'
+    headers can be changed per container.
+    """
+
+    def __init__(self):
+        FakeSwift.__init__(self)
+        #: The method and path of every request made.
+        self.requests = []
+        #: The bodies of responses that weren't closed yet.
+        self.unclosed = set()
+        #: The seconds listing requests take.
+        self.delay = 0
+        #: Headers to set (or, if None, remove) per container.
+        self.headers = {}
+        #: The object names (unicode) of containers listing these instead
+        #: of synthetic ones.
+        self.objects = {}
+
+    def __call__(self, env, start_response):
+        self.requests.append((env['REQUEST_METHOD'], env['PATH_INFO']))
+        if self.delay and env['REQUEST_METHOD'] == 'GET' and \
+                env['PATH_INFO'].count('/') == 3:
+            # Let concurrent requests catch up with this listing.
+            eventlet.sleep(self.delay)
+        return TrackedBody(FakeSwift.__call__(self, env, start_response),
+                           self.unclosed)
+
+    def container(self, env, start_response, container, count):
+        overrides = self.headers.get(container, {})
+
+        def set_headers(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in overrides]
+            headers.extend((name, value) for name, value in overrides.items()
+                           if value is not None)
+            return start_response(status, headers, exc_info)
+
+        self.listed = container
+        try:
+            return FakeSwift.container(self, env, set_headers, container,
+                                       count)
+        finally:
+            if container in self.objects:
+                # Generated listings are kept per size and query, not per
+                # container.
+                self._listings.pop((count, env.get('QUERY_STRING', '')),
+                                   None)
+
+    def listing(self, count, params):
+        names = self.objects.get(self.listed)
+        if names is None:
+            return FakeSwift.listing(self, count, params)
+
+        def param(name, default=''):
+            return params.get(name, [default])[0].decode('utf-8')
+
+        prefix = param('prefix')
+        delimiter = param('delimiter')
+        marker = param('marker')
+        end_marker = param('end_marker')
+        reverse = param('reverse') == 'true'
+
+        entries = []
+        for name in sorted(names):
+            if not name.startswith(prefix):
+                continue
+            if delimiter and delimiter in name[len(prefix):]:
+                subdir = name[:name.index(delimiter, len(prefix)) + 1]
+                if not entries or entries[-1].get('subdir') != subdir:
+                    entries.append({'subdir': subdir})
+                continue
+            entries.append({
+                'name': name,
+                'hash': '0' * 32,
+                'bytes': len(name),
+                'content_type': 'text/plain',
+                'last_modified': '2013-06-01T12:00:00.000000',
+            })
+
+        def key(entry):
+            return entry.get('subdir') or entry['name']
+
+        if reverse:
+            entries = [entry for entry in reversed(entries)
+                       if (not marker or key(entry) < marker) and
+                       (not end_marker or key(entry) > end_marker)]
+        else:
+            entries = [entry for entry in entries
+                       if (not marker or key(entry) > marker) and
+                       (not end_marker or key(entry) < end_marker)]
+
+        return json.dumps(entries[:int(param('limit', '10000'))])
+
+    def listings(self):
+        """
+        Returns the number of listing requests made.
+        """
+        return len([path for method, path in self.requests
+                    if method == 'GET' and path.count('/') == 3])
+
+
+class StaticWebTestCase(unittest.TestCase):
+
+    conf = {}
+
+    def setUp(self):
+        self.backend = RecordingSwift()
+        self.cache = FakeMemcache()
+        self.app = better_staticweb.filter_factory({}, **self.conf)(
+            self.backend)
+
+    def request(self, path, method='GET', close=True, **headers):
+        """
+        Makes a request to the middleware.
+
+        :returns: the status, the headers (with lower case names) and the
+            body; the body iterable instead if close is False.
+        """
+        env = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'HTTP_HOST': 'localhost',
+            'HTTP_ACCEPT': 'text/html',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'swift.cache': self.cache,
+        }
+        if '?' in path:
+            env['PATH_INFO'], env['QUERY_STRING'] = path.split('?', 1)
+        for name, value in headers.items():
+            env['HTTP_' + name.upper()] = value
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response.append(status)
+            response.append(dict((k.lower(), v) for k, v in headers))
+
+        body = self.app(env, start_response)
+        if not close:
+            return response[0], response[1], body
+
+        try:
+            content = ''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return response[0], response[1], content
+
+
+class TestCaching(StaticWebTestCase):
+
+    path = '/v1/%s/c10/' % ACCOUNT
+
+    def test_public_listing_is_cached(self):
+        status, headers, body = self.request(self.path)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.backend.listings(), 1)
+
+        status, headers, cached = self.request(self.path)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(cached, body)
+        self.assertEqual(self.backend.listings(), 1)
+
+    def test_private_listing_is_fetched_every_time(self):
+        self.backend.headers['c10'] = {'x-container-read': None,
+                                       'x-container-meta-web-listings': None}
+        for i in range(2):
+            status, headers, body = self.request(self.path, x_auth_token='t')
+            self.assertEqual(status, '200 OK')
+        self.assertEqual(self.backend.listings(), 2)
+
+        # Neither can the client skip the listing with a 304.
+        status, headers, body = self.request(
+            self.path, x_auth_token='t', if_none_match=headers['etag'])
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(self.backend.listings(), 3)
+
+    def test_not_modified(self):
+        status, headers, body = self.request(self.path)
+        self.assertEqual(status, '200 OK')
+
+        # The generation is read back from memcache now.
+        for i in range(2):
+            status, headers_304, body = self.request(
+                self.path, if_none_match=headers['etag'])
+            self.assertEqual(status, '304 Not Modified')
+            self.assertEqual(headers_304['etag'], headers['etag'])
+            self.assertEqual(body, '')
+        self.assertEqual(self.backend.listings(), 1)
+
+    def test_validators_outlive_rendered_listings(self):
+        status, headers, body = self.request(self.path)
+
+        # Once the rendered listing expires it's rendered again, for the
+        # same generation.
+        now = time.time()
+        self.cache.clock = lambda: now + 301
+        status, headers_later, body = self.request(self.path)
+        self.assertEqual(self.backend.listings(), 2)
+        self.assertEqual(headers_later['etag'], headers['etag'])
+        self.assertEqual(headers_later['last-modified'],
+                         headers['last-modified'])
+
+        self.cache.clock = lambda: now + 86401
+        status, headers_later, body = self.request(self.path)
+        self.assertNotEqual(headers_later['etag'], headers['etag'])
+
+    def test_template_error_closes_listing(self):
+        # Private listings are fetched while the template is.
+        self.backend.headers['c10'] = {'x-container-read': None,
+                                       'x-container-meta-web-listings': None}
+        del self.backend.extra_objects['listing.html']
+        status, headers, body = self.request(self.path, x_auth_token='t')
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.backend.listings(), 1)
+        self.assertEqual(self.backend.unclosed, set())
+
+    def test_write_invalidates_after_it_is_done(self):
+        status, headers, write = self.request(
+            self.path + 'd0000/new.txt', method='PUT', close=False)
+        # A listing cached while the write is under way is dropped too.
+        self.request(self.path)
+        self.assertEqual(self.backend.listings(), 1)
+        write.close()
+
+        self.request(self.path)
+        self.assertEqual(self.backend.listings(), 2)
+
+    def test_copy_invalidates_destination(self):
+        self.request('/v1/%s/p10/' % ACCOUNT)
+
+        status, headers, body = self.request(
+            self.path + 'd0000/o0000000.txt', method='COPY',
+            destination='/p10/d0000/copy.txt')
+
+        self.request('/v1/%s/p10/' % ACCOUNT)
+        self.assertEqual(self.backend.listings(), 2)
+
+    def test_head_does_not_render(self):
+        status, headers, body = self.request(self.path, method='HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, '')
+        self.assertNotIn('content-length', headers)
+        self.assertEqual(self.backend.listings(), 0)
+
+        status, get_headers, body = self.request(self.path)
+        status, headers, body = self.request(self.path, method='HEAD')
+        self.assertEqual(headers['etag'], get_headers['etag'])
+        self.assertEqual(headers['content-length'],
+                         get_headers['content-length'])
+        self.assertEqual(self.backend.listings(), 1)
+
+
+class TestCompression(StaticWebTestCase):
+
+    path = '/v1/%s/p10k/' % ACCOUNT
+
+    def test_gzip(self):
+        status, headers, plain = self.request(self.path)
+        self.assertNotIn('content-encoding', headers)
+
+        status, gzip_headers, body = self.request(
+            self.path, accept_encoding='deflate;q=0.5, gzip')
+        self.assertEqual(gzip_headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip_headers['vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), plain)
+        self.assertEqual(gzip_headers['etag'],
+                         headers['etag'][:-1] + '-gzip"')
+
+        # Each variant only matches its own ETag.
+        status, headers_304, body = self.request(
+            self.path, accept_encoding='gzip',
+            if_none_match=gzip_headers['etag'])
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers_304['etag'], gzip_headers['etag'])
+        status, headers, body = self.request(
+            self.path, if_none_match=gzip_headers['etag'])
+        self.assertEqual(status, '200 OK')
+
+    def test_compressed_copy_is_cached(self):
+        status, headers, body = self.request(self.path,
+                                             accept_encoding='deflate')
+        self.assertEqual(headers['content-encoding'], 'deflate')
+        self.assertEqual(self.backend.listings(), 1)
+
+        compressed = [key for key in self.cache.data
+                      if key.endswith('/deflate')]
+        self.assertEqual(len(compressed), 1)
+        self.assertEqual(self.cache.get(compressed[0]), body)
+
+        status, headers, cached = self.request(self.path,
+                                               accept_encoding='deflate')
+        self.assertEqual(cached, body)
+        self.assertEqual(self.backend.listings(), 1)
+
+    def test_small_responses_are_not_compressed(self):
+        status, headers, body = self.request(
+            '/v1/%s/p10/d0000/missing.txt' % ACCOUNT, accept_encoding='gzip')
+        self.assertEqual(status, '404 Not Found')
+        self.assertNotIn('content-encoding', headers)
+
+
+class TestCompressionOff(StaticWebTestCase):
+
+    conf = {'compress_level': '0'}
+
+    def test_not_compressed(self):
+        status, headers, body = self.request('/v1/%s/p10k/' % ACCOUNT,
+                                             accept_encoding='gzip')
+        self.assertNotIn('content-encoding', headers)
+        self.assertIn('d0009/', body)
+
+
+class TestStreaming(StaticWebTestCase):
+
+    conf = {'stream_listings': 'true', 'listing_page_size': '2'}
+
+    path = '/v1/%s/n/' % ACCOUNT
+
+    def setUp(self):
+        StaticWebTestCase.setUp(self)
+        self.backend.objects['n'] = [u'a/x', u'b.txt', u'c/x', u'd.txt',
+                                     u'e/x', u'f.txt']
+        self.backend.containers['n'] = 6
+
+    def names(self):
+        status, headers, body = self.request(self.path)
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('content-length', headers)
+        return re.findall(r'<td class="colname"><a href="[^"]*">([^<]*)<',
+                          body)
+
+    def test_kinds_share_the_walk(self):
+        self.app = better_staticweb.filter_factory(
+            {}, **dict(self.conf, listing_page_size='1000'))(self.backend)
+        self.assertEqual(self.names(),
+                         ['../', 'a/', 'c/', 'e/', 'b.txt', 'd.txt', 'f.txt'])
+        self.assertEqual(self.backend.listings(), 1)
+
+    def test_files_beyond_the_kept_ones_are_fetched_again(self):
+        self.assertEqual(self.names(),
+                         ['../', 'a/', 'c/', 'e/', 'b.txt', 'd.txt', 'f.txt'])
+        # Four pages for the subdirectories, the files kept meanwhile, and
+        # two more pages for the files after d.txt.
+        self.assertEqual(self.backend.listings(), 6)
+
+    def test_listing_walk(self):
+        pages = []
+
+        def walk(after=None):
+            pages.append(after)
+            entries = [{'subdir': 'p/a/'}, {'name': 'p/b'}, {'name': 'p/c'},
+                       {'subdir': 'p/d/'}, {'name': 'p/e'}]
+            if after is not None:
+                entries = [entry for entry in entries
+                           if (entry.get('subdir') or entry['name']) >
+                           'p/' + after]
+            return iter(entries)
+
+        shared = better_staticweb.ListingWalk(walk, 'p/', 1)
+        self.assertEqual([entry['subdir'] for entry in
+                          shared.iter_kind('subdir')], ['p/a/', 'p/d/'])
+        self.assertEqual([entry['name'] for entry in
+                          shared.iter_kind('name')], ['p/b', 'p/c', 'p/e'])
+        # Only one file was kept; the rest was walked again from after it.
+        self.assertEqual(pages, [None, 'b'])
+
+        # Later loops walk the listing again.
+        self.assertEqual(len(list(shared.iter_kind('subdir'))), 2)
+        self.assertEqual(pages, [None, 'b', None])
+
+
+class TestSingleFlight(StaticWebTestCase):
+
+    path = '/v1/%s/c10/' % ACCOUNT
+
+    def test_concurrent_requests_share_a_render(self):
+        self.backend.delay = 0.01
+        requests = [eventlet.spawn(self.request, self.path)
+                    for i in range(5)]
+        bodies = [request.wait()[2] for request in requests]
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertEqual(self.backend.listings(), 1)
+        self.assertEqual(self.app.flights.shared, 4)
+
+    def test_waiters_share_the_result(self):
+        flights = better_staticweb.SingleFlight(1)
+        calls = []
+
+        def call():
+            calls.append(1)
+            eventlet.sleep(0.01)
+            return 'result'
+
+        waiters = [eventlet.spawn(flights.run, 'key', call)
+                   for i in range(3)]
+        self.assertEqual([waiter.wait() for waiter in waiters],
+                         ['result'] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flights.shared, flights.fallbacks), (2, 0))
+
+    def test_waiters_fall_back(self):
+        # Without a result to share, waiters make the call themselves.
+        flights = better_staticweb.SingleFlight(1)
+        calls = []
+
+        def call():
+            calls.append(1)
+            eventlet.sleep(0.01)
+
+        waiters = [eventlet.spawn(flights.run, 'key', call)
+                   for i in range(3)]
+        for waiter in waiters:
+            waiter.wait()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((flights.shared, flights.fallbacks), (0, 2))
+
+    def test_waiters_time_out(self):
+        flights = better_staticweb.SingleFlight(0.01)
+
+        def call():
+            eventlet.sleep(0.1)
+            return 'slow'
+
+        first = eventlet.spawn(flights.run, 'key', call)
+        eventlet.sleep(0)
+        self.assertEqual(flights.run('key', lambda: 'own'), 'own')
+        self.assertEqual(first.wait(), 'slow')
+        self.assertEqual(flights.fallbacks, 1)
+
+
+class TestFastPath(StaticWebTestCase):
+
+    def test_object_is_passed_on(self):
+        path = '/v1/%s/c10/d0000/o0000000.txt' % ACCOUNT
+        status, headers, body = self.request(path)
+        self.assertEqual(status, '200 OK')
+        # Without looking at the container's metadata.
+        self.assertEqual(self.backend.requests, [('GET', path)])
+
+    def test_api_request_is_passed_on(self):
+        path = '/v1/%s/c10' % ACCOUNT
+        status, headers, body = self.request(path, x_auth_token='t',
+                                             accept='application/json')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.backend.requests, [('GET', path)])
+
+    def test_missing_object_gets_error_page(self):
+        path = '/v1/%s/c10/d0000/missing.txt' % ACCOUNT
+        status, headers, body = self.request(path)
+        self.assertEqual(status, '404 Not Found')
+        self.assertIn('Nothing to see here.', body)
+        self.assertEqual(self.backend.requests[0], ('GET', path))
+        self.assertIn(('HEAD', '/v1/%s/c10' % ACCOUNT),
+                      self.backend.requests)
+
+
+class TestPaging(StaticWebTestCase):
+
+    conf = {'listing_page_size': '1000'}
+
+    path = '/v1/%s/p10k/d0003/' % ACCOUNT
+
+    def links(self, query):
+        status, headers, body = self.request(self.path + '?' + query)
+        self.assertEqual(status, '200 OK')
+        return re.findall(r'href="\?([^"]*marker[^"]*)"',
+                          body.replace('&amp;', '&'))
+
+    def test_first_page_reached_backwards(self):
+        self.assertEqual(self.links('limit=300&end_marker=o0003300.txt'),
+                         ['limit=300&marker=o0003299.txt'])
+
+    def test_page_reached_backwards(self):
+        self.assertEqual(self.links('limit=300&end_marker=o0003400.txt'),
+                         ['limit=300&end_marker=o0003100.txt',
+                          'limit=300&marker=o0003399.txt'])
+
+
+class TestViews(StaticWebTestCase):
+
+    path = u'/v1/%s/n/café/' % ACCOUNT
+
+    def setUp(self):
+        StaticWebTestCase.setUp(self)
+        names = [u'café/a.txt', u'café/bb.jpg', u'café/cccc.txt',
+                 u'café/sub/x.txt', u'top.txt']
+        self.backend.objects['n'] = names
+        self.backend.containers['n'] = len(names)
+
+    def names(self, query=''):
+        status, headers, body = self.request(
+            (self.path + query).encode('utf-8'))
+        self.assertEqual(status, '200 OK')
+        return re.findall(r'<td class="colname"><a href="[^"]*">([^<]*)<',
+                          body)
+
+    def test_non_ascii_directory(self):
+        self.assertEqual(self.names(),
+                         ['../', 'sub/', 'a.txt', 'bb.jpg', 'cccc.txt'])
+
+    def test_filter(self):
+        self.assertEqual(self.names('?filter=JP'), ['../', 'bb.jpg'])
+        self.assertEqual(self.names('?filter=*.txt'),
+                         ['../', 'a.txt', 'cccc.txt'])
+
+    def test_sort(self):
+        # The default template lists subdirectories first.
+        self.assertEqual(self.names('?sort=size&order=desc'),
+                         ['../', 'sub/', 'cccc.txt', 'bb.jpg', 'a.txt'])
+        self.assertEqual(self.names('?sort=size&limit=2'),
+                         ['../', 'sub/', 'a.txt'])
+        self.assertEqual(self.names('?sort=name&order=desc&limit=2'),
+                         ['../', 'sub/', 'cccc.txt'])
+
+    def test_filtered_pages(self):
+        status, headers, body = self.request(
+            (self.path + '?filter=txt&limit=1').encode('utf-8'))
+        self.assertIn('href="?filter=txt&amp;limit=1&amp;marker=a.txt"',
+                      body)
+
+        status, headers, body = self.request(
+            (self.path + '?filter=txt&limit=1&marker=a.txt').encode('utf-8'))
+        self.assertIn('>cccc.txt<', body)
+        self.assertNotIn('>a.txt<', body)
+
+    def test_sort_links_keep_filter_and_limit(self):
+        status, headers, body = self.request(
+            (self.path + '?filter=txt&limit=2&sort=size&order=desc'
+             '&marker=a.txt').encode('utf-8'))
+        links = re.findall(r'<th class="col\w+"><a href="([^"]*)"', body)
+        self.assertEqual([link.replace('&amp;', '&') for link in links], [
+            '?filter=txt&limit=2&order=asc&sort=name',
+            '?filter=txt&limit=2&order=asc&sort=size',
+            '?filter=txt&limit=2&order=desc&sort=date',
+        ])
+
+
+class TestWebIndex(StaticWebTestCase):
+
+    def setUp(self):
+        StaticWebTestCase.setUp(self)
+        self.backend.headers['p10'] = {
+            'x-container-meta-web-index': 'index.html'}
+        self.backend.extra_objects[u'my dir/é/index.html'.encode('utf-8')] \
+            = 'the index'
+
+    def test_index_with_quoted_name(self):
+        path = u'/v1/%s/p10/my dir/é/' % ACCOUNT
+        status, headers, body = self.request(path.encode('utf-8'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, 'the index')
+
+        # Once it's known to be there, it's fetched right away.
+        del self.backend.requests[:]
+        status, headers, body = self.request(path.encode('utf-8'))
+        self.assertEqual(body, 'the index')
+        self.assertEqual([method for method, path in self.backend.requests],
+                         ['GET'])
+
+    def test_missing_index_shows_listing(self):
+        path = '/v1/%s/p10/d0000/' % ACCOUNT
+        for i in range(2):
+            status, headers, body = self.request(path)
+            self.assertEqual(status, '200 OK')
+            self.assertIn('o0000009.txt', body)
+
+        probes = [path for method, path in self.backend.requests
+                  if method == 'HEAD' and path.endswith('index.html')]
+        self.assertEqual(probes, ['/v1/%s/p10/d0000/index.html' % ACCOUNT])
+
+
+class TestErrorPages(StaticWebTestCase):
+
+    conf = {'error_page_cache_bytes': '150'}
+
+    def fetches(self):
+        """
+        Returns the number of error pages fetched.
+        """
+        return len([path for method, path in self.backend.requests
+                    if path.endswith('/404error.html')])
+
+    def test_error_page_is_cached(self):
+        path = '/v1/%s/c10/missing.txt' % ACCOUNT
+        for i in range(2):
+            status, headers, body = self.request(path)
+            self.assertEqual(status, '404 Not Found')
+            self.assertIn('Nothing to see here.', body)
+        self.assertEqual(self.fetches(), 1)
+
+        # Until the container changes.
+        self.request('/v1/%s/c10/new.txt' % ACCOUNT, method='PUT')
+        self.request(path)
+        self.assertEqual(self.fetches(), 2)
+
+    def test_missing_error_page_is_remembered(self):
+        self.backend.headers['c10'] = {
+            'x-container-meta-web-error': 'missing.html'}
+        for i in range(2):
+            status, headers, body = self.request(
+                '/v1/%s/c10/missing.txt' % ACCOUNT)
+            self.assertEqual(status, '404 Not Found')
+            self.assertIn('<h1>404 Not Found</h1>', body)
+        self.assertEqual(
+            [path for method, path in self.backend.requests
+             if path.endswith('/404missing.html')],
+            ['/v1/%s/c10/404missing.html' % ACCOUNT])
+
+    def test_cache_is_bounded_by_size(self):
+        for container in ('c10', 'c10k', 'c10'):
+            status, headers, body = self.request(
+                '/v1/%s/%s/missing.txt' % (ACCOUNT, container))
+            self.assertEqual(status, '404 Not Found')
+            self.assertIn('Nothing to see here.', body)
+
+        # The page of c10 was dropped to make room for that of c10k.
+        self.assertEqual(self.fetches(), 3)
+        self.assertEqual(len(self.app.error_pages), 1)
+        self.assertLessEqual(self.app.error_pages.bytes, 150)
+
+
+class TestDirectoryProbes(StaticWebTestCase):
+
+    def test_directory_is_redirected(self):
+        for i in range(2):
+            status, headers, body = self.request(
+                '/v1/%s/p10/d0000?x=1' % ACCOUNT)
+            self.assertEqual(status, '302 Found')
+            self.assertEqual(headers['location'],
+                             '/v1/%s/p10/d0000/?x=1' % ACCOUNT)
+        self.assertEqual(self.backend.listings(), 1)
+
+    def test_missing_object_is_remembered(self):
+        for i in range(2):
+            status, headers, body = self.request(
+                '/v1/%s/p10/d0000/missing.txt' % ACCOUNT)
+            self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.backend.listings(), 1)
+
+        # Until the container changes.
+        self.request('/v1/%s/p10/d0000/missing.txt/x' % ACCOUNT,
+                     method='PUT')
+        self.request('/v1/%s/p10/d0000/missing.txt' % ACCOUNT)
+        self.assertEqual(self.backend.listings(), 2)
+
+
+class TestSandbox(StaticWebTestCase):
+
+    conf = {'template_max_operations': '10000',
+            'template_max_output': '100000'}
+
+    path = '/v1/%s/c10/d0000/' % ACCOUNT
+
+    def render(self, template):
+        self.backend.extra_objects['listing.html'] = template
+        return self.request(self.path)
+
+    def test_template_renders(self):
+        status, headers, body = self.render(
+            '{% for file in files %}{{ file.name }} {% endfor %}')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body.split(), ['o%07d.txt' % index
+                                        for index in range(10)])
+
+    def assertFallsBack(self, template):
+        started = time.time()
+        status, headers, body = self.render(template)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(status, '200 OK')
+        # The default template is used instead.
+        self.assertIn('<!DOCTYPE HTML PUBLIC', body)
+
+    def test_operations_limit(self):
+        self.assertFallsBack(
+            '{% for i in range(1000) %}{% for file in files %}'
+            '{{ file.name }}{% endfor %}{% endfor %}')
+
+    def test_output_limit(self):
+        self.assertFallsBack(
+            '{% for i in range(1000) %}{{ "x" * 1000 }}{% endfor %}')
+
+    def test_repeated_string_limit(self):
+        self.assertFallsBack("{{ 'x' * 10**10 }}")
+
+    def test_power_limit(self):
+        self.assertFallsBack("{{ 10 ** 1000000 }}")
+
+    def test_format_width_limit(self):
+        self.assertFallsBack("{{ ('%0200000000d' % 1)|length }}")
+        self.assertFallsBack("{{ '%*d'|format(200000000, 1) }}")
+        self.assertFallsBack("{{ '{:>200000000}'.format(1) }}")
+
+    def test_padding_limit(self):
+        self.assertFallsBack("{{ 'x'|center(200000000)|length }}")
+        self.assertFallsBack("{{ 'abc'.center(200000000)|length }}")
+        self.assertFallsBack("{{ 'abc'.ljust(200000000)|length }}")
+        self.assertFallsBack("{{ 'abc'.rjust(200000000)|length }}")
+        self.assertFallsBack("{{ '1'.zfill(200000000)|length }}")
+
+    def test_indent_limit(self):
+        self.assertFallsBack("{{ ('a\n' * 1000)|indent(1000)|length }}")
+
+    def test_wordwrap_and_truncate_limit(self):
+        self.assertFallsBack("{{ 'a b'|wordwrap(200000000) }}")
+        self.assertFallsBack("{{ 'a b'|truncate(200000000) }}")
+
+    def test_replace_limit(self):
+        self.assertFallsBack("{{ ('a' * 1000)|replace('a', 'b' * 1000) }}")
+
+    def test_small_formatting_renders(self):
+        status, headers, body = self.render(
+            "{{ '%5d'|format(3) }}|{{ 'ab'|center(6) }}|{{ '%.2f' % 3.14159 }}"
+            "|{{ '{:>4}'.format('x') }}|{{ 'a b c d'|truncate(20) }}")
+        self.assertEqual(body, '    3|  ab  |3.14|   x|a b c d')
+
+    def test_large_template_is_not_read(self):
+        self.assertFallsBack('x' * (256 * 1024 + 1))
+        self.assertEqual(len(self.app.remote_templates), 0)
+
+    def test_unsafe_attribute(self):
+        self.assertFallsBack("{{ files.__class__.__mro__ }}")
+
+
+class TestBytecodeCache(unittest.TestCase):
+
+    def test_unusable_directory(self):
+        # A file where the directory should be.
+        conf = {'template_path': os.path.dirname(__file__) or '.',
+                'template_bytecode_cache': 'README.md/bytecode'}
+        app = better_staticweb.filter_factory({}, **conf)(RecordingSwift())
+        self.assertIsNone(app.bytecode_cache)
+
+
+class TestIndexes(StaticWebTestCase):
+
+    conf = {'indexes': 'true'}
+
+    def test_sitemap_urls_are_quoted(self):
+        self.backend.containers['my c'] = 10
+        status, headers, body = self.request(
+            '/v1/%s/my c/?format=sitemap' % ACCOUNT)
+        self.assertEqual(status, '200 OK')
+        self.assertIn('<loc>http://localhost/v1/%s/my%%20c/d0000/'
+                      'o0000000.txt</loc>' % ACCOUNT, body)
+
+    def test_sitemap_is_cached_per_host(self):
+        path = '/v1/%s/p10/?format=sitemap' % ACCOUNT
+        status, headers, body = self.request(path, host='evil.example')
+        self.assertIn('<loc>http://evil.example/', body)
+
+        status, other_headers, body = self.request(path)
+        self.assertIn('<loc>http://localhost/', body)
+        self.assertNotIn('evil.example', body)
+        self.assertNotEqual(other_headers['etag'], headers['etag'])
+
+        status, headers, body = self.request(
+            path, if_none_match=headers['etag'])
+        self.assertEqual(status, '200 OK')
+
+    def test_non_ascii_directory(self):
+        self.backend.objects['n'] = [u'café/a b.txt', u'café/sub/ü.txt',
+                                     u'top.txt']
+        self.backend.containers['n'] = 3
+        path = u'/v1/%s/n/café/' % ACCOUNT
+
+        status, headers, body = self.request(
+            (path + '?format=sitemap').encode('utf-8'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(re.findall('<loc>(.*?)</loc>', body), [
+            'http://localhost/v1/%s/n/caf%%C3%%A9/a%%20b.txt' % ACCOUNT,
+            'http://localhost/v1/%s/n/caf%%C3%%A9/sub/%%C3%%BC.txt' % ACCOUNT,
+        ])
+
+        status, headers, body = self.request(
+            (path + '?format=sitemap&marker=a b.txt').encode('utf-8'))
+        self.assertEqual(len(re.findall('<loc>', body)), 1)
+
+        status, headers, body = self.request(
+            (path + '?format=index').encode('utf-8'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([item['name'] for item in json.loads(body)],
+                         [u'café/a b.txt', u'café/sub/ü.txt'])
+
+    def test_large_sitemap_is_split(self):
+        status, headers, body = self.request(
+            '/v1/%s/p1m/?format=sitemap' % ACCOUNT)
+        self.assertEqual(status, '200 OK')
+        parts = re.findall('<loc>(.*?)</loc>', body)
+        self.assertEqual(len(parts), 20)
+        self.assertTrue(parts[1].endswith(
+            '?format=sitemap&amp;marker=d0049%2Fo0049999.txt'))
+
+        status, headers, body = self.request(
+            parts[1].replace('http://localhost', '').replace('&amp;', '&'))
+        urls = re.findall('<loc>(.*?)</loc>', body)
+        self.assertEqual(len(urls), 50000)
+        self.assertTrue(urls[0].endswith('d0050/o0050000.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()